@@ -1,112 +1,2484 @@
+import argparse
 import asyncio
+import bisect
+import functools
+import hashlib
+import itertools
 import json
+import mmap
+import multiprocessing
+import operator
+import random
 import re
-from typing import Dict, List, Any, TypedDict, Annotated
-from urllib.parse import quote_plus
-import google.generativeai as genai
-from langchain_core.messages import HumanMessage, SystemMessage
-from langgraph.graph import StateGraph, END
-from langgraph.graph.message import add_messages
-from playwright.async_api import async_playwright
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field, replace
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, List, Any, NamedTuple, Optional, Tuple, TypedDict, Annotated
+from urllib.parse import quote_plus, urlparse
 import os
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    import numpy as np
+    from aiohttp import web
+
 # Load environment variables
 load_dotenv()
 
+class StreamEvent(TypedDict):
+    """An incremental result yielded by ShoppingAgent.stream_query"""
+    type: str
+    data: Dict[str, Any]
+
+# Event queue of the stream_query call that the current task belongs to, if any.
+# Graph nodes and scraper tasks inherit it through their asyncio context.
+_stream_events: ContextVar[Optional[asyncio.Queue]] = ContextVar("stream_events", default=None)
+
+def emit_event(event_type: str, **data):
+    """Publish a StreamEvent to the active stream_query, or do nothing outside one"""
+    queue = _stream_events.get()
+    if queue is not None:
+        queue.put_nowait(StreamEvent(type=event_type, data=data))
+
+# Span log of the query being profiled, if any (see ShoppingAgent.profile_dir)
+_query_profile: ContextVar[Optional[Dict[str, Any]]] = ContextVar("query_profile", default=None)
+
+# Searches ahead started by the current query, settled when the query ends
+_searches_ahead: ContextVar[Optional[List[asyncio.Task]]] = ContextVar("searches_ahead", default=None)
+
+def add_messages(left: list, right: list) -> list:
+    """LangGraph's message reducer, imported only once a graph actually runs"""
+    from langgraph.graph.message import add_messages as merge_messages
+    return merge_messages(left, right)
+
+def merge_dicts(left: Dict[str, Any], right: Dict[str, Any]) -> Dict[str, Any]:
+    """State reducer that merges dict updates from parallel graph branches"""
+    return {**left, **right}
+
+class Offer(NamedTuple):
+    """One store's listing of a product"""
+    source: str
+    price: float
+    url: Optional[str]
+
+@dataclass(slots=True)
+class Product:
+    """A product as ranked and recommended, merged across listings
+    
+    Scrapers and the result cache work with plain dicts; these records are
+    built once all sites are in. ``offers`` holds every listing of the
+    product, cheapest first, and the top-level price, url and source are those
+    of the cheapest one.
+    """
+    title: str
+    price: float
+    source: str
+    url: Optional[str] = None
+    rating: Any = "N/A"
+    reviews_count: Optional[int] = None
+    brand: Optional[str] = None
+    mrp: Optional[float] = None
+    discount: Optional[int] = None
+    offers: List[Offer] = field(default_factory=list)
+    score: Optional[float] = None
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Product":
+        """Build a record from a scraped product dict"""
+        return cls(
+            title=data["title"],
+            price=data["price"],
+            source=data["source"],
+            url=data.get("url"),
+            rating=data.get("rating", "N/A"),
+            reviews_count=data.get("reviews_count"),
+            brand=data.get("brand"),
+            mrp=data.get("mrp"),
+            discount=data.get("discount"),
+            offers=[Offer(data["source"], data["price"], data.get("url"))],
+        )
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain-dict form, with offers as dicts"""
+        data = asdict(self)
+        data["offers"] = [offer._asdict() for offer in self.offers]
+        return data
+
 class AgentState(TypedDict):
     messages: Annotated[list, add_messages]
     user_query: str
     product_name: str
     budget: float
-    scraped_products: List[Dict[str, Any]]
+    scrape_deadline: float
+    scraped_products: Annotated[List[Dict[str, Any]], operator.add]
+    products: List[Product]
     final_recommendations: List[Dict[str, Any]]
+    timings: Annotated[Dict[str, float], merge_dicts]
 
-class ProductScraper:
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# Text that marks a static response as a bot check rather than search results
+BOT_CHECK_MARKERS = [
+    "captcha",
+    "robot check",
+    "are you a human",
+    "api-services-support@amazon.com",
+    "/errors/validatecaptcha",
+    "access denied",
+]
+
+# Maximum number of product cards read from a single results page
+MAX_CARDS_PER_PAGE = 20
+
+# Selector fallbacks for each retailer, tried in order. Every field lists its
+# candidate selectors and how matched elements are read and filtered:
+#   attribute          read this attribute instead of the element text
+#   fallback_attribute read this attribute when the element text is empty
+#   contains           keep only values containing one of these substrings
+#   min_length         keep only values at least this long
+#   limit              only look at the first N matches of each selector
+FLIPKART_SELECTORS = {
+    "base_url": "https://www.flipkart.com",
+    "cards": [
+        "[data-id]",
+        "._1AtVbE",
+        "._13oc-S",
+        "._1fQZEK",
+        ".s1Q9rs",
+        "._2kHMtA"
+    ],
+    "fields": {
+        "url": {
+            "selectors": [
+                "a[href*='/p/']",
+                "a[title]",
+                "a[href]",
+                "._1fQZEK",
+                ".s1Q9rs",
+                "._4rR01T",
+                "._2WkVRV"
+            ],
+            "attribute": "href",
+            "contains": ["/p/", "/dp/"]
+        },
+        "title": {
+            "selectors": [
+                "._4rR01T",
+                ".s1Q9rs",
+                "._2WkVRV",
+                ".IRpwTa",
+                "a[title]",
+                "._1fQZEK",
+                "a span",
+                "div[title]"
+            ],
+            "fallback_attribute": "title",
+            "min_length": 11,
+            "limit": 3
+        },
+        "price": {
+            "selectors": [
+                "._30jeq3",
+                "._1_WHN1",
+                "._3tbHP2",
+                "._1vC4OE",
+                "._30jeq3._1_WHN1",
+                ".CEmiEU",
+                "._1_WHN1._30jeq3"
+            ]
+        },
+        "rating": {
+            "selectors": [
+                "._3LWZlK",
+                "._3LWZlK div",
+                "._3LWZlK span",
+                "[class*='rating']",
+                "._13vcmD"
+            ],
+            "limit": 1
+        },
+        "mrp": {
+            "selectors": ["._3I9_wc", "._27UcVY"]
+        },
+        "discount": {
+            "selectors": ["._3Ay6Sb", "._3Ay6Sb span"],
+            "contains": ["%"]
+        },
+        "reviews_count": {
+            "selectors": ["._2_R_DZ", "._2_R_DZ span"],
+            "limit": 1
+        },
+        "brand": {
+            "selectors": ["._2WkVRV"],
+            "limit": 1
+        }
+    }
+}
+
+AMAZON_SELECTORS = {
+    "base_url": "https://www.amazon.in",
+    "cards": [
+        "div[data-component-type='s-search-result']"
+    ],
+    "fields": {
+        "url": {
+            "selectors": [
+                "h2 a[href]",
+                "a[href*='/dp/']",
+                "a[href*='/gp/product/']",
+                ".a-link-normal[href]",
+                "a[data-component-type='s-product-image']",
+                ".s-image[href]"
+            ],
+            "attribute": "href",
+            "contains": ["/dp/", "/gp/product/"]
+        },
+        "title": {
+            "selectors": [
+                "div[data-cy='title-recipe'] h2.a-size-base-plus span",
+                "div[data-cy='title-recipe'] h2 span",
+                "h2.a-size-mini a span",
+                "h2.a-size-mini span",
+                "h2 a span",
+                "h2 span",
+                ".a-size-base-plus",
+                ".a-size-medium"
+            ],
+            "min_length": 11,
+            "limit": 3
+        },
+        "rating": {
+            "selectors": [
+                "span[aria-label*='out of 5 stars']",
+                "span.a-icon-alt",
+                "div[data-cy='reviews-block'] span.a-size-small.a-color-base",
+                ".a-icon-alt"
+            ],
+            "fallback_attribute": "aria-label",
+            "limit": 1
+        },
+        "price": {
+            "selectors": [
+                "span.a-price span.a-offscreen",
+                "span.a-price-whole",
+                ".a-price .a-offscreen",
+                ".a-price-range .a-price .a-offscreen",
+                ".a-price"
+            ]
+        },
+        "mrp": {
+            "selectors": [
+                "span.a-price.a-text-price span.a-offscreen",
+                ".a-text-price .a-offscreen"
+            ]
+        },
+        "discount": {
+            "selectors": ["span.a-letter-space + span", ".a-row span"],
+            "contains": ["% off"]
+        },
+        "reviews_count": {
+            "selectors": [
+                "span.a-size-base.s-underline-text",
+                "a[href*='customerReviews'] span",
+                "span[aria-label$='ratings']"
+            ],
+            "fallback_attribute": "aria-label",
+            "limit": 1
+        },
+        "brand": {
+            "selectors": [
+                # The title span carries the same classes plus a-text-normal
+                "div[data-cy='title-recipe'] span.a-size-base-plus.a-color-base:not(.a-text-normal)",
+                "h5 span.a-size-base-plus",
+                ".s-line-clamp-1 span.a-color-base"
+            ],
+            "limit": 1
+        }
+    }
+}
+
+SITE_SELECTORS = {
+    "Flipkart": FLIPKART_SELECTORS,
+    "Amazon": AMAZON_SELECTORS,
+}
+
+def flipkart_search_url(base_url: str, term: str, page_number: int, max_price: Optional[float] = None) -> str:
+    """Flipkart results sorted by price, limited to ``max_price`` with its price range facet"""
+    url = f"{base_url}/search?q={quote_plus(term)}&sort=price_asc&page={page_number}"
+    if max_price is not None:
+        url += f"&p%5B%5D=facets.price_range.from%3DMin&p%5B%5D=facets.price_range.to%3D{int(max_price)}"
+    return url
+
+def amazon_search_url(base_url: str, term: str, page_number: int, max_price: Optional[float] = None) -> str:
+    """Amazon results by relevance, limited to ``max_price`` with the p_36 price refinement (in paise)"""
+    url = f"{base_url}/s?k={quote_plus(term)}&page={page_number}"
+    if max_price is not None:
+        url += f"&rh=p_36%3A-{int(max_price * 100)}"
+    return url
+
+# Search URL builder per site: (base_url, term, page_number, max_price) -> url
+SEARCH_URLS = {
+    "Flipkart": flipkart_search_url,
+    "Amazon": amazon_search_url,
+}
+
+# Requests aborted while scraping. "default" applies to every site and each
+# site's lists are added on top of it:
+#   block_types    Playwright resource types to abort
+#   deny_domains   hosts (and their subdomains) to abort whatever the type
+#   allow_domains  hosts that are never aborted, even for blocked types
+RESOURCE_POLICIES = {
+    "default": {
+        "block_types": ["image", "media", "font", "stylesheet", "texttrack", "manifest"],
+        "deny_domains": [
+            "google-analytics.com",
+            "googletagmanager.com",
+            "doubleclick.net",
+            "googlesyndication.com",
+            "facebook.net",
+            "facebook.com",
+            "hotjar.com",
+            "criteo.com",
+            "scorecardresearch.com"
+        ],
+        "allow_domains": []
+    },
+    "Flipkart": {
+        "block_types": [],
+        "deny_domains": ["rukminim1.flixcart.com", "rukminim2.flixcart.com"],
+        "allow_domains": []
+    },
+    "Amazon": {
+        "block_types": [],
+        "deny_domains": ["amazon-adsystem.com", "fls-eu.amazon.in", "unagi.amazon.in"],
+        "allow_domains": []
+    },
+}
+
+def domain_matches(host: str, domains: List[str]) -> bool:
+    """Check whether host is one of the domains or a subdomain of one"""
+    return any(host == domain or host.endswith("." + domain) for domain in domains)
+
+# When a results page counts as ready, per site:
+#   stable_ms    the product card count must stay unchanged for this long
+#   max_wait_ms  hard cap; extraction starts anyway once it is reached
+#   poll_ms      how often the card count is sampled in the page
+#   responses    URL substrings of network responses that must also arrive
+READINESS_POLICIES = {
+    "Flipkart": {"stable_ms": 300, "max_wait_ms": 8000, "poll_ms": 100, "responses": []},
+    "Amazon": {"stable_ms": 300, "max_wait_ms": 15000, "poll_ms": 100, "responses": []},
+}
+
+# Resolves true once at least one card exists and the card count has not
+# changed for stableMs. State lives on window, so it resets on navigation.
+CARDS_STABLE_JS = """
+([selector, stableMs]) => {
+    const count = document.querySelectorAll(selector).length;
+    const now = performance.now();
+    const state = window.__cardWatch || (window.__cardWatch = {count: -1, since: now});
+    if (count !== state.count) {
+        state.count = count;
+        state.since = now;
+        return false;
+    }
+    return count > 0 && now - state.since >= stableMs;
+}
+"""
+
+# Reads every field of every card in a single browser round trip. Returns, per
+# card, the candidate values of each field as [selector_index, value] pairs in
+# fallback order; Python picks the first candidate that parses.
+EXTRACT_CARDS_JS = """
+(cards, [fields, maxCards, maxCandidates]) => cards.slice(0, maxCards).map(card => {
+    const record = {};
+    for (const [name, spec] of Object.entries(fields)) {
+        const candidates = [];
+        spec.selectors.forEach((selector, index) => {
+            if (candidates.length >= maxCandidates) return;
+            let elements;
+            try {
+                elements = Array.from(card.querySelectorAll(selector));
+            } catch (e) {
+                return;
+            }
+            if (spec.limit) elements = elements.slice(0, spec.limit);
+            for (const element of elements) {
+                let value = spec.attribute
+                    ? element.getAttribute(spec.attribute)
+                    : (element.innerText || element.textContent);
+                if (!(value || '').trim() && spec.fallback_attribute) {
+                    value = element.getAttribute(spec.fallback_attribute);
+                }
+                value = (value || '').trim();
+                if (!value) continue;
+                if (spec.contains && !spec.contains.some(part => value.includes(part))) continue;
+                if (spec.min_length && value.length < spec.min_length) continue;
+                candidates.push([index, value]);
+                if (candidates.length >= maxCandidates) break;
+            }
+        });
+        record[name] = candidates;
+    }
+    return record;
+})
+"""
+
+def parse_price(text: str) -> Optional[float]:
+    """Parse a rupee amount such as '₹1,299.00', ignoring implausibly small values"""
+    price_match = re.search(r'₹?(\d+(?:,\d+)*(?:\.\d+)?)', text)
+    if price_match:
+        try:
+            price_value = float(price_match.group(1).replace(',', ''))
+        except ValueError:
+            return None
+        if price_value > 100:  # Reasonable minimum
+            return price_value
+    return None
+
+def parse_rating(text: str) -> Optional[float]:
+    """Parse a 0-5 star rating such as '4.3 out of 5 stars'"""
+    rating_match = re.search(r'(\d+\.?\d*)', text)
+    if rating_match:
+        rating_value = float(rating_match.group(1))
+        if 0 <= rating_value <= 5:
+            return rating_value
+    return None
+
+def parse_count(text: str) -> Optional[int]:
+    """Parse the first integer in a string such as '1,234 Ratings & 120 Reviews'"""
+    count_match = re.search(r'(\d+(?:,\d+)*)', text)
+    if count_match:
+        return int(count_match.group(1).replace(',', ''))
+    return None
+
+def parse_discount(text: str) -> Optional[int]:
+    """Parse a percentage discount such as '23% off'"""
+    discount_match = re.search(r'(\d+)\s*%', text)
+    if discount_match:
+        return int(discount_match.group(1))
+    return None
+
+def absolute_url(base_url: str, relative_url: str) -> str:
+    """Resolve a product href against the retailer's base URL"""
+    if relative_url.startswith('/'):
+        return f"{base_url}{relative_url}"
+    if relative_url.startswith('http'):
+        return relative_url
+    return f"{base_url}/{relative_url}"
+
+# How each field's raw text is turned into a value; None means it is rejected
+FIELD_PARSERS = {
+    "title": lambda text: text if len(text) > 10 else None,
+    "price": parse_price,
+    "rating": parse_rating,
+    "mrp": parse_price,
+    "discount": parse_discount,
+    "reviews_count": parse_count,
+    "brand": lambda text: text or None,
+}
+
+def within_budget(product: Dict[str, Any], budget: Optional[float]) -> bool:
+    """Check a product's price against the budget (None means no limit)"""
+    return budget is None or product['price'] <= budget
+
+# Filler words that do not change what a retailer search returns
+STOP_WORDS = {"a", "an", "the", "for", "with", "and", "of", "in", "to", "new", "best", "buy"}
+
+def normalize_product_name(name: str) -> str:
+    """Normalize a product name so near-identical searches share a cache key"""
+    tokens = re.sub(r'[^\w\s]', ' ', name.lower()).split()
+    return " ".join(sorted(set(token for token in tokens if token not in STOP_WORDS)))
+
+# Multipliers for budget shorthands such as 30k, 1.5 lakh or 1 cr
+AMOUNT_UNITS = {
+    "k": 1e3, "thousand": 1e3,
+    "l": 1e5, "lakh": 1e5, "lakhs": 1e5, "lac": 1e5, "lacs": 1e5,
+    "cr": 1e7, "crore": 1e7, "crores": 1e7,
+}
+
+# An amount with optional currency prefix and unit suffix, e.g. "₹1,20,000", "rs 30k"
+AMOUNT_PATTERN = r"(₹|rs\.?|inr)?\s*(\d+(?:,\d+)*(?:\.\d+)?)\s*(k|thousand|lakhs?|lacs?|l|crores?|cr)?(?![\w])"
+
+BUDGET_KEYWORD_RE = re.compile(
+    r"\b(?:under|below|within|less than|upto|up to|not more than|max(?:imum)?|budget(?: of| is)?)\s*(?:of\s*)?"
+    + AMOUNT_PATTERN,
+    re.IGNORECASE
+)
+BUDGET_RANGE_RE = re.compile(
+    r"\b(between|from)?\s*" + AMOUNT_PATTERN + r"\s*(?:-|to|and)\s*" + AMOUNT_PATTERN,
+    re.IGNORECASE
+)
+BUDGET_BARE_RE = re.compile(AMOUNT_PATTERN, re.IGNORECASE)
+
+# Leading phrases that carry no product information
+QUERY_FILLER_RE = re.compile(
+    r"^(?:(?:i|we)\s+(?:want|need|would like)(?:\s+to\s+(?:buy|get|purchase))?|looking\s+for|searching\s+for|"
+    r"show\s+me|find\s+me|find|suggest(?:\s+me)?|recommend(?:\s+me)?|need|want|buy|get|"
+    r"a|an|some|the|best|good|please)\b\s*",
+    re.IGNORECASE
+)
+
+def _amount(currency: Optional[str], number: str, unit: Optional[str]) -> float:
+    value = float(number.replace(",", ""))
+    return value * AMOUNT_UNITS.get((unit or "").lower(), 1)
+
+def parse_query_locally(query: str) -> Optional[Dict[str, Any]]:
+    """Extract product name and budget without the LLM when the query is unambiguous
+    
+    Handles "under/below/within/upto 30k", "₹1.5 lakh", "10k-20k" and
+    "between 10000 and 20000" (the upper bound is the budget). Returns None
+    when there is no budget, more than one candidate budget, or no product
+    words left, so the caller can fall back to the LLM.
+    """
+    matches = []
+    for match in BUDGET_KEYWORD_RE.finditer(query):
+        matches.append((match.span(), _amount(*match.groups())))
+    
+    if not matches:
+        for match in BUDGET_RANGE_RE.finditer(query):
+            keyword, c1, n1, u1, c2, n2, u2 = match.groups()
+            # Without a keyword, bare numbers like "15 to 16" are not a price range
+            if keyword or c1 or u1 or c2 or u2:
+                # "10-20k" means 10k-20k
+                unit = u1 or u2
+                matches.append((match.span(), max(_amount(c1, n1, u1 or unit), _amount(c2, n2, u2 or unit))))
+    
+    if not matches:
+        for match in BUDGET_BARE_RE.finditer(query):
+            currency, _, unit = match.groups()
+            # A bare number is only a price when it has a currency or unit
+            if currency or unit:
+                matches.append((match.span(), _amount(*match.groups())))
+    
+    if len(matches) != 1:
+        return None
+    
+    (start, end), budget = matches[0]
+    if budget < 100:
+        return None
+    
+    product_name = query[:start] + " " + query[end:]
+    
+    # Another priced amount elsewhere ("under 20k or 30k") makes the budget ambiguous
+    for match in BUDGET_BARE_RE.finditer(product_name):
+        if match.group(1) or match.group(3):
+            return None
+    
+    product_name = clean_product_name(product_name)
+    if not re.search(r"[a-zA-Z]", product_name):
+        return None
+    
+    return {"product_name": product_name, "budget": budget}
+
+def clean_product_name(text: str) -> str:
+    """Strip price words, leading filler and dangling connectives from what is left of a query"""
+    text = re.sub(r"\b(?:rupees|rs|inr|price|budget|range|around|please)\b", " ", text, flags=re.IGNORECASE)
+    text = re.sub(r"[^\w\s+\-\"'./]", " ", text)
+    text = " ".join(text.split())
+    
+    previous = None
+    while previous != text:
+        previous = text
+        text = QUERY_FILLER_RE.sub("", text).strip()
+        text = re.sub(r"\s+(?:with|and|in|of|to|for|or|maybe|about)$", "", text, flags=re.IGNORECASE).strip(" -./")
+    return text
+
+def guess_product_term(query: str) -> Optional[str]:
+    """Guess the product words of a query that parse_query_locally gave up on
+    
+    Every priced amount and budget phrase is dropped, however many there are,
+    so "phone for my dad, 20k or maybe 25k" still gives "phone for my dad".
+    Only good enough to start searching early: the LLM parse has the final say.
+    Returns None when no product words are left.
+    """
+    text = BUDGET_KEYWORD_RE.sub(" ", query)
+    text = BUDGET_BARE_RE.sub(lambda match: " " if match.group(1) or match.group(3) else match.group(0), text)
+    text = clean_product_name(text)
+    return text if re.search(r"[a-zA-Z]", text) else None
+
+def guess_budget_ceiling(query: str) -> Optional[float]:
+    """The largest priced amount in a query that parse_query_locally gave up on
+    
+    "phone for my dad, 20k or maybe 25k" gives 25000: whichever amount the
+    LLM settles on, results capped there still cover it. Returns None when
+    the query names no price.
+    """
+    amounts = [_amount(*match.groups()) for match in BUDGET_KEYWORD_RE.finditer(query)]
+    amounts += [
+        _amount(*match.groups()) for match in BUDGET_BARE_RE.finditer(query)
+        if match.group(1) or match.group(3)
+    ]
+    amounts = [amount for amount in amounts if amount >= 100]
+    return max(amounts) if amounts else None
+
+class DiskCache:
+    """SQLite-backed TTL cache with size-bounded LRU eviction
+    
+    Entries live in namespaces (e.g. "search" for raw per-site results) that
+    are evicted independently. Methods are blocking; call them through
+    asyncio.to_thread from async code.
+    """
+    def __init__(self, path: str = ".shopping_cache.sqlite3", ttl: float = 3600.0, max_entries: int = 2000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at)")
+    
+    def get(self, namespace: str, key: str, ttl: Optional[float] = None) -> Optional[Any]:
+        """Return the cached value, or None if it is missing or older than the TTL"""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM cache WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > ttl:
+                self._conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+                return None
+            self._conn.execute(
+                "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, namespace, key)
+            )
+        return json.loads(row[0])
+    
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        """Store a JSON-serializable value and evict expired entries and LRU overflow
+        
+        ``ttl`` should match the one used to read the namespace.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), now, now)
+            )
+            self._conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND created_at < ?",
+                (namespace, now - ttl)
+            )
+            self._conn.execute(
+                """
+                DELETE FROM cache WHERE namespace = ? AND key NOT IN (
+                    SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT ?
+                )
+                """,
+                (namespace, namespace, self.max_entries)
+            )
+    
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
+
+def extractor_version(site: str) -> str:
+    """Fingerprint of a site's selector table; parses remembered under another version are stale
+    
+    Keyed by the static table rather than the learned order (SelectorStats),
+    which changes from page to page without changing what the selectors mean.
+    """
+    config = SITE_SELECTORS[site]
+    return f"{zlib.crc32(json.dumps([config['cards'], config['fields']], sort_keys=True).encode()):08x}"
+
+def snapshot_digest(html: str) -> str:
+    """Content address of a page in the snapshot store"""
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+def ignore_sigint():
+    """Worker process initializer: Ctrl+C is the parent's to handle, not every worker's"""
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def extract_snapshot(segment_path: str, offset: int, length: int, site: str) -> List[Dict[str, Any]]:
+    """Parse one stored page straight from its segment file (runs in worker processes)"""
+    with open(segment_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+        html = zlib.decompress(segment[offset:offset + length]).decode("utf-8")
+    return parse_search_html(html, site)
+
+class SnapshotStore:
+    """Content-addressed store of fetched search results pages
+    
+    Pages are zlib-compressed and appended to segment files, which are never
+    rewritten and are read back through mmap. A SQLite index maps each page's
+    SHA-256 digest to its location, each URL to the digest last fetched from
+    it, and each digest to the products parsed from it with the current
+    selectors, so a page that has not changed is not parsed again. Methods
+    are blocking; call them through asyncio.to_thread from async code.
+    """
+    def __init__(self, path: str = ".snapshots", segment_bytes: int = 256 * 1024 * 1024, compression_level: int = 6):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.compression_level = compression_level
+        self._lock = threading.Lock()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._conn = sqlite3.connect(os.path.join(path, "index.sqlite3"), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    digest TEXT PRIMARY KEY,
+                    site TEXT NOT NULL,
+                    segment INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS fetches (
+                    url TEXT PRIMARY KEY,
+                    site TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS parses (
+                    digest TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    products TEXT NOT NULL,
+                    PRIMARY KEY (digest, version)
+                )
+            """)
+            self._segment = self._conn.execute("SELECT COALESCE(MAX(segment), 0) FROM pages").fetchone()[0]
+    
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"segment-{segment:05d}.seg")
+    
+    def put(self, site: str, url: str, html: str) -> str:
+        """Record a fetched page and return its digest; known content is not written again"""
+        data = html.encode("utf-8")
+        digest = snapshot_digest(html)
+        with self._lock:
+            known = self._conn.execute("SELECT 1 FROM pages WHERE digest = ?", (digest,)).fetchone() is not None
+        
+        # Compress outside the lock; a concurrent duplicate only wastes a few bytes
+        compressed = None if known else zlib.compress(data, self.compression_level)
+        now = time.time()
+        with self._lock, self._conn:
+            if compressed is not None:
+                segment, offset = self._append(compressed)
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO pages (digest, site, segment, offset, length, size, stored_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (digest, site, segment, offset, len(compressed), len(data), now)
+                )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fetches (url, site, digest, fetched_at) VALUES (?, ?, ?, ?)",
+                (url, site, digest, now)
+            )
+        return digest
+    
+    def _append(self, compressed: bytes) -> Tuple[int, int]:
+        """Append to the current segment, starting a new one when it is full"""
+        path = self.segment_path(self._segment)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset and offset + len(compressed) > self.segment_bytes:
+            self._segment += 1
+            path = self.segment_path(self._segment)
+            offset = 0
+        with open(path, "ab") as f:
+            f.write(compressed)
+        return self._segment, offset
+    
+    def read(self, digest: str) -> Optional[str]:
+        """Return a stored page's HTML, or None if the digest is unknown"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT segment, offset, length FROM pages WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row is None:
+                return None
+            segment, offset, length = row
+            
+            # Remap once the segment has grown past the mapped size
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < offset + length:
+                if mapped is not None:
+                    mapped.close()
+                with open(self.segment_path(segment), "rb") as f:
+                    mapped = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            compressed = mapped[offset:offset + length]
+        return zlib.decompress(compressed).decode("utf-8")
+    
+    def products(self, digest: str, version: str) -> Optional[List[Dict[str, Any]]]:
+        """Return the products parsed from a page with the given extractor version, if any"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT products FROM parses WHERE digest = ? AND version = ?", (digest, version)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def save_products(self, digest: str, version: str, products: List[Dict[str, Any]]):
+        """Remember the products parsed from a page"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parses (digest, version, products) VALUES (?, ?, ?)",
+                (digest, version, json.dumps(products))
+            )
+    
+    def fetches(self, site: Optional[str] = None) -> List[Dict[str, Any]]:
+        """The latest snapshot of every stored URL, with where its page lives"""
+        query = """
+            SELECT f.url, f.site, f.digest, f.fetched_at, p.segment, p.offset, p.length
+            FROM fetches f JOIN pages p ON p.digest = f.digest
+        """
+        params: Tuple = ()
+        if site is not None:
+            query += " WHERE f.site = ?"
+            params = (site,)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY f.fetched_at", params).fetchall()
+        keys = ("url", "site", "digest", "fetched_at", "segment", "offset", "length")
+        return [dict(zip(keys, row)) for row in rows]
+    
+    def reextract(self, site: Optional[str] = None, workers: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Re-run extraction over every stored page with the current selectors
+        
+        Each distinct page is parsed once, in worker processes reading the
+        segment files directly, and its products replace the remembered parse.
+        Returns one ``{"url", "site", "fetched_at", "products"}`` record per URL.
+        """
+        fetches = self.fetches(site)
+        pages = {fetch["digest"]: fetch for fetch in fetches}
+        
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=ignore_sigint
+        ) as pool:
+            futures = {
+                digest: pool.submit(
+                    extract_snapshot, self.segment_path(page["segment"]), page["offset"], page["length"], page["site"]
+                )
+                for digest, page in pages.items()
+            }
+            products = {digest: future.result() for digest, future in futures.items()}
+        
+        for digest, page in pages.items():
+            self.save_products(digest, extractor_version(page["site"]), products[digest])
+        
+        return [
+            {"url": fetch["url"], "site": fetch["site"], "fetched_at": fetch["fetched_at"], "products": products[fetch["digest"]]}
+            for fetch in fetches
+        ]
+    
+    def close(self):
+        """Close the index and unmap the segments"""
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+            self._conn.close()
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one shared task
+    
+    The first caller for a key starts the work; callers arriving while it is
+    still running await the same task instead of repeating it. Nothing is kept
+    once the task finishes, so later calls start fresh (that is the cache's job).
+    The work is cancelled only when every caller waiting on it has been.
+    """
+    
     def __init__(self):
+        self._calls: Dict[Any, asyncio.Future] = {}
+        self._waiters: Dict[asyncio.Future, int] = {}
+    
+    async def do(self, key: Any, factory) -> Tuple[Any, bool]:
+        """Return ``(result, shared)``; ``shared`` is True when another caller did the work"""
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # One caller giving up must not cancel the work the others are waiting on
+            return await asyncio.shield(task), shared
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters.get(task) == 1:
+                task.cancel()
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+    
+    def running(self, key: Any) -> bool:
+        """Whether work for ``key`` is currently in progress"""
+        return key in self._calls
+    
+    def _forget(self, key: Any, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+    
+    def __len__(self) -> int:
+        return len(self._calls)
+
+class Metrics:
+    """Process-wide counters and latency histograms
+    
+    ``span(name, **labels)`` times a block into the ``<name>_seconds``
+    histogram; ``inc`` bumps a counter. Everything can be exported as
+    Prometheus text or JSON. While a query is being profiled, each observation
+    is also appended to that query's span log.
+    """
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
+    def __init__(self, prefix: str = "shopping", buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], float] = defaultdict(float)
+        # (name, labels) -> {"buckets": per-bucket counts (last one is +Inf), "sum", "count"}
+        self._histograms: Dict[Tuple[str, Tuple], Dict[str, Any]] = {}
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """Add ``value`` to a counter"""
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+    
+    def observe(self, name: str, value: float, **labels):
+        """Record one histogram observation"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            histogram["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+        
+        profile = _query_profile.get()
+        if profile is not None:
+            profile["spans"].append({
+                "name": name,
+                **labels,
+                "start": round(time.perf_counter() - value - profile["started"], 4),
+                "seconds": round(value, 4),
+            })
+    
+    @contextmanager
+    def span(self, name: str, **labels):
+        """Time the enclosed block into the ``<name>_seconds`` histogram"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - started, **labels)
+    
+    def reset(self):
+        """Drop everything recorded so far"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+    
+    def to_json(self) -> Dict[str, Any]:
+        """Snapshot as plain data; histogram buckets are cumulative, keyed by upper bound"""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = []
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative = list(itertools.accumulate(histogram["buckets"]))
+                histograms.append({
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram["count"],
+                    "sum": round(histogram["sum"], 6),
+                    "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], cumulative)),
+                })
+        return {"counters": counters, "histograms": histograms}
+    
+    def to_prometheus(self) -> str:
+        """Render in the Prometheus text exposition format"""
+        def labels_text(labels: Dict[str, Any], **extra) -> str:
+            pairs = {**labels, **extra}
+            if not pairs:
+                return ""
+            escaped = (
+                str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                for value in pairs.values()
+            )
+            return "{" + ",".join(f'{key}="{value}"' for key, value in zip(pairs, escaped)) + "}"
+        
+        snapshot = self.to_json()
+        lines = []
+        typed = set()
+        for counter in snapshot["counters"]:
+            name = f"{self.prefix}_{counter['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{labels_text(counter['labels'])} {counter['value']:g}")
+        for histogram in snapshot["histograms"]:
+            name = f"{self.prefix}_{histogram['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in histogram["buckets"].items():
+                lines.append(f"{name}_bucket{labels_text(histogram['labels'], le=bound)} {count}")
+            lines.append(f"{name}_sum{labels_text(histogram['labels'])} {histogram['sum']:g}")
+            lines.append(f"{name}_count{labels_text(histogram['labels'])} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+# Shared by the scraper, the agent and the HTTP service
+METRICS = Metrics()
+
+# HTTP statuses of model API errors worth retrying: rate limits and server-side failures
+RETRYABLE_LLM_STATUSES = {408, 429, 500, 502, 503, 504}
+
+def is_retryable_llm_error(error: BaseException) -> bool:
+    """Whether a failed LLM call may succeed if simply tried again"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    # google.api_core errors carry the HTTP status as ``code``
+    return getattr(error, "code", None) in RETRYABLE_LLM_STATUSES
+
+class LLMClient:
+    """Async LLM calls with deadlines, jittered retries, hedging and a concurrency limit
+    
+    ``backend`` is anything with Gemini's ``generate_content_async(prompt,
+    generation_config=..., stream=...)``, e.g. a stub for offline runs; by
+    default the Gemini model is configured on first use. Each attempt gets
+    ``attempt_timeout`` seconds and a call gives up retrying once ``call_timeout``
+    has passed. Once ``hedge_min_samples`` calls have been timed, a call still
+    unanswered at the ``hedge_percentile`` latency sends a duplicate request if
+    a slot is free, and the first answer wins.
+    """
+    
+    def __init__(self, backend=None, model_name: str = "gemini-2.0-flash-exp", concurrency: int = 4,
+                 attempt_timeout: float = 10.0, call_timeout: float = 25.0, retries: int = 2, backoff: float = 0.5,
+                 hedge_percentile: Optional[float] = 0.95, hedge_min_samples: int = 20, latency_window: int = 200):
+        self._backend = backend
+        self._backend_lock = threading.Lock()
+        self.model_name = model_name
+        
+        # Sized to the API quota; hedged duplicates only use spare slots
+        self.slots = asyncio.Semaphore(concurrency)
+        
+        self.attempt_timeout = attempt_timeout
+        self.call_timeout = call_timeout
+        self.retries = retries
+        self.backoff = backoff
+        
+        # Recent successful attempt latencies decide when to hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies: deque = deque(maxlen=latency_window)
+    
+    @property
+    def backend(self):
+        """The model backend, configured on first use"""
+        with self._backend_lock:
+            if self._backend is None:
+                import google.generativeai as genai
+                
+                # Configure Google Gemini
+                genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+                self._backend = genai.GenerativeModel(self.model_name)
+            return self._backend
+    
+    @backend.setter
+    def backend(self, backend):
+        self._backend = backend
+    
+    async def warm_up(self):
+        """Configure the backend and open its API connection with a free token count"""
+        backend = await asyncio.to_thread(lambda: self.backend)
+        if hasattr(backend, "count_tokens_async"):
+            await asyncio.wait_for(backend.count_tokens_async("ping"), timeout=self.attempt_timeout)
+    
+    def hedge_delay(self) -> Optional[float]:
+        """How long to wait before sending a duplicate request, or None to never hedge"""
+        if self.hedge_percentile is None or len(self._latencies) < self.hedge_min_samples:
+            return None
+        import numpy as np
+        return float(np.percentile(self._latencies, self.hedge_percentile * 100))
+    
+    async def generate(self, prompt: str, stage: str = "llm", max_output_tokens: Optional[int] = None) -> str:
+        """Return the response text, retrying transient failures until the call deadline"""
+        generation_config = {"max_output_tokens": max_output_tokens} if max_output_tokens else None
+        deadline = time.monotonic() + self.call_timeout
+        
+        with METRICS.span("llm_call", stage=stage):
+            for retry in itertools.count():
+                try:
+                    return await self._hedged(prompt, generation_config, stage, deadline)
+                except Exception as e:
+                    await self._before_retry(e, retry, stage, deadline)
+    
+    async def stream(self, prompt: str, stage: str = "llm", max_output_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        """Yield the response text in chunks
+        
+        Failures are retried only until the first chunk arrives; after that
+        the caller has already seen part of the answer.
+        """
+        generation_config = {"max_output_tokens": max_output_tokens} if max_output_tokens else None
+        deadline = time.monotonic() + self.call_timeout
+        
+        with METRICS.span("llm_call", stage=stage):
+            for retry in itertools.count():
+                started = False
+                try:
+                    async with self.slots:
+                        timeout = self._attempt_timeout(deadline)
+                        attempt_deadline = time.monotonic() + timeout
+                        response = await asyncio.wait_for(
+                            self.backend.generate_content_async(prompt, generation_config=generation_config, stream=True),
+                            timeout=timeout
+                        )
+                        chunks = response.__aiter__()
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(
+                                    chunks.__anext__(), timeout=max(0.0, attempt_deadline - time.monotonic())
+                                )
+                            except StopAsyncIteration:
+                                return
+                            started = True
+                            yield chunk.text
+                except Exception as e:
+                    if started:
+                        raise
+                    await self._before_retry(e, retry, stage, deadline)
+    
+    async def _hedged(self, prompt: str, generation_config: Optional[Dict[str, Any]], stage: str, deadline: float) -> str:
+        """Run one attempt, racing a duplicate against it if it runs unusually long"""
+        first = asyncio.ensure_future(self._attempt(prompt, generation_config, deadline))
+        attempts = [first]
+        try:
+            hedge_delay = self.hedge_delay()
+            if hedge_delay is not None:
+                await asyncio.wait(attempts, timeout=hedge_delay)
+            
+            # Never queue a duplicate behind real calls
+            if first.done() or hedge_delay is None or self.slots.locked():
+                return await first
+            
+            METRICS.inc("llm_hedges_total", stage=stage)
+            attempts.append(asyncio.ensure_future(self._attempt(prompt, generation_config, deadline)))
+            pending = set(attempts)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not first:
+                            METRICS.inc("llm_hedge_wins_total", stage=stage)
+                        return attempt.result()
+                    error = attempt.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+    
+    async def _attempt(self, prompt: str, generation_config: Optional[Dict[str, Any]], deadline: float) -> str:
+        """One request within a concurrency slot and the attempt timeout"""
+        async with self.slots:
+            # Before creating the request: a passed deadline must not leave it unawaited
+            timeout = self._attempt_timeout(deadline)
+            started = time.perf_counter()
+            response = await asyncio.wait_for(
+                self.backend.generate_content_async(prompt, generation_config=generation_config),
+                timeout=timeout
+            )
+            self._latencies.append(time.perf_counter() - started)
+            return response.text
+    
+    def _attempt_timeout(self, deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError("LLM call deadline passed")
+        return min(self.attempt_timeout, remaining)
+    
+    async def _before_retry(self, error: Exception, retry: int, stage: str, deadline: float):
+        """Re-raise ``error`` unless it is worth retrying; otherwise back off with full jitter"""
+        if isinstance(error, asyncio.TimeoutError):
+            METRICS.inc("llm_timeouts_total", stage=stage)
+        
+        delay = random.uniform(0, self.backoff * 2 ** retry)
+        if retry >= self.retries or not is_retryable_llm_error(error) or time.monotonic() + delay >= deadline:
+            raise error
+        
+        METRICS.inc("llm_retries_total", stage=stage)
+        print(f"⚠️ LLM call failed ({type(error).__name__}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+def build_product(site: str, record: Dict[str, List], hits: Optional[Dict[str, int]] = None) -> Optional[Dict[str, Any]]:
+    """Turn the raw field candidates of one card into a product dict
+    
+    ``record`` maps field names to [selector_index, raw_value] pairs in
+    fallback order, as produced by EXTRACT_CARDS_JS. The index of the
+    selector that supplied each field is written to ``hits`` when given.
+    """
+    config = SITE_SELECTORS[site]
+    product_info = {
+        'title': None,
+        'rating': None,
+        'price': None,
+        'reviews_count': None,
+        'brand': None,
+        'mrp': None,
+        'discount': None,
+        'url': None
+    }
+    
+    for name, candidates in record.items():
+        for selector_index, raw_value in candidates:
+            if name == "url":
+                value = absolute_url(config["base_url"], raw_value)
+            else:
+                value = FIELD_PARSERS[name](raw_value)
+            if value is not None:
+                product_info[name] = value
+                if hits is not None:
+                    hits[name] = selector_index
+                break
+    
+    if not (product_info['title'] and product_info['price']):
+        return None
+    
+    # A brand selector that caught the title instead says nothing about the brand
+    if product_info['brand'] and product_info['brand'].strip().lower() == product_info['title'].strip().lower():
+        product_info['brand'] = None
+        if hits is not None:
+            hits.pop('brand', None)
+    
+    if product_info['discount'] is None and product_info['mrp'] and product_info['mrp'] > product_info['price']:
+        product_info['discount'] = round((1 - product_info['price'] / product_info['mrp']) * 100)
+    
+    # Set default rating if not found
+    if product_info['rating'] is None:
+        product_info['rating'] = "N/A"
+    
+    product_info['source'] = site
+    return product_info
+
+# Compiled lxml selectors, cached per worker process
+_compiled_selectors: Dict[str, Any] = {}
+
+def _select(element, selector: str) -> List[Any]:
+    """Run a CSS selector against an lxml element, caching the compiled XPath"""
+    compiled = _compiled_selectors.get(selector)
+    if compiled is None:
+        from lxml.cssselect import CSSSelector
+        try:
+            compiled = CSSSelector(selector)
+        except Exception:
+            compiled = False
+        _compiled_selectors[selector] = compiled
+    return compiled(element) if compiled else []
+
+def extract_card_record(card, fields: Dict[str, Dict], max_candidates: int = 8) -> Dict[str, List]:
+    """Collect field candidates from an lxml card element (mirrors EXTRACT_CARDS_JS)"""
+    record = {}
+    for name, spec in fields.items():
+        candidates = []
+        for index, selector in enumerate(spec["selectors"]):
+            elements = _select(card, selector)
+            if spec.get("limit"):
+                elements = elements[:spec["limit"]]
+            for element in elements:
+                if spec.get("attribute"):
+                    value = element.get(spec["attribute"]) or ""
+                else:
+                    value = " ".join(element.text_content().split())
+                if not value.strip() and spec.get("fallback_attribute"):
+                    value = element.get(spec["fallback_attribute"]) or ""
+                value = value.strip()
+                if not value:
+                    continue
+                if spec.get("contains") and not any(part in value for part in spec["contains"]):
+                    continue
+                if spec.get("min_length") and len(value) < spec["min_length"]:
+                    continue
+                candidates.append([index, value])
+                if len(candidates) >= max_candidates:
+                    break
+            if len(candidates) >= max_candidates:
+                break
+        record[name] = candidates
+    return record
+
+def extract_search_records(html: str, card_selectors: List[str], fields: Dict[str, Dict], max_cards: int = MAX_CARDS_PER_PAGE):
+    """Parse a results page and return (matched card selector, raw card records)
+    
+    This is the CPU-heavy half of HTML extraction and runs in a worker process.
+    """
+    from lxml import html as lxml_html
+    
+    document = lxml_html.fromstring(html)
+    
+    for selector in card_selectors:
+        cards = _select(document, selector)
+        if cards:
+            return selector, [extract_card_record(card, fields) for card in cards[:max_cards]]
+    return None, []
+
+def parse_search_html(html: str, site: str, max_cards: int = MAX_CARDS_PER_PAGE) -> List[Dict[str, Any]]:
+    """Extract products from a saved search results page without a browser
+    
+    Uses the same selector data as the in-browser extractors, so it can run
+    against HTML fixtures on disk.
+    """
+    config = SITE_SELECTORS[site]
+    _, records = extract_search_records(html, config["cards"], config["fields"], max_cards)
+    
+    products = []
+    for record in records:
+        product_info = build_product(site, record)
+        if product_info:
+            products.append(product_info)
+    return products
+
+class SelectorStats:
+    """Learns which selectors win for each site and field
+    
+    Candidate lists are reordered by hit count so the usual winner is tried
+    first, and selectors that never hit are pruned once enough cards have been
+    seen. Every ``explore_every`` pages, or whenever the recent hit rate of a
+    field falls well below its long-run rate (e.g. after a layout change), the
+    pruned selectors are tried again at the end of the list.
+    """
+    def __init__(self, path: Optional[str] = ".selector_stats.json", explore_every: int = 10,
+                 prune_after: int = 100, save_every: int = 200, window: int = 50):
+        self.path = path
+        self.explore_every = explore_every
+        self.prune_after = prune_after
+        self.save_every = save_every
+        
+        # "site:field" -> {"trials": int, "found": int, "hits": {selector: int}}
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self._recent: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self._calls: Dict[str, int] = defaultdict(int)
+        self._unsaved = 0
+        self.load()
+    
+    def load(self):
+        """Load persisted statistics, starting fresh if the file is missing or corrupt"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.stats = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring selector stats in {self.path}: {e}")
+            self.stats = {}
+    
+    def save(self):
+        """Persist statistics atomically"""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.stats, f)
+            os.replace(tmp_path, self.path)
+            self._unsaved = 0
+        except OSError as e:
+            print(f"Could not save selector stats: {e}")
+    
+    def _exploring(self, key: str, entry: Dict[str, Any]) -> bool:
+        if self._calls[key] % self.explore_every == 0:
+            return True
+        recent = self._recent[key]
+        if len(recent) < 10 or not entry["trials"]:
+            return False
+        return sum(recent) / len(recent) < entry["found"] / entry["trials"] - 0.2
+    
+    def order(self, site: str, field: str, selectors: List[str]) -> List[str]:
+        """Return ``selectors`` with the historically best ones first"""
+        key = f"{site}:{field}"
+        entry = self.stats.get(key)
+        if not entry:
+            return list(selectors)
+        
+        self._calls[key] += 1
+        hits = entry["hits"]
+        ranked = sorted(selectors, key=lambda selector: -hits.get(selector, 0))
+        
+        if entry["trials"] < self.prune_after or self._exploring(key, entry):
+            return ranked
+        return [selector for selector in ranked if hits.get(selector, 0) > 0] or ranked
+    
+    def ordered_fields(self, site: str) -> Dict[str, Dict[str, Any]]:
+        """Return the site's field specs with learned selector order"""
+        return {
+            field: {**spec, "selectors": self.order(site, field, spec["selectors"])}
+            for field, spec in SITE_SELECTORS[site]["fields"].items()
+        }
+    
+    def record(self, site: str, field: str, selector: Optional[str]):
+        """Record the selector that produced a value, or None for a miss"""
+        key = f"{site}:{field}"
+        entry = self.stats.setdefault(key, {"trials": 0, "found": 0, "hits": {}})
+        entry["trials"] += 1
+        if selector is not None:
+            entry["found"] += 1
+            entry["hits"][selector] = entry["hits"].get(selector, 0) + 1
+        self._recent[key].append(1 if selector is not None else 0)
+        METRICS.inc("selector_hits_total" if selector is not None else "selector_misses_total", site=site, field=field)
+        
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+# Weights of the local ranking features (see rank_products)
+RANKING_WEIGHTS = {
+    "relevance": 0.4,
+    "rating": 0.3,
+    "budget_fit": 0.15,
+    "value": 0.15,
+}
+
+def rank_products(products: List[Product], product_name: str, budget: float) -> List[Product]:
+    """Score products locally and return copies sorted best first, with ``score`` set
+    
+    Features, each scaled to 0-1 and combined with RANKING_WEIGHTS:
+      relevance   share of the searched product terms found in the title
+      rating      star rating / 5 (unrated products get 0.5)
+      budget_fit  closeness of the price to the budget, where capable products sit
+      value       cheapness relative to the other candidates
+    """
+    if not products:
+        return []
+    
+    import numpy as np
+    prices = np.array([product.price for product in products], dtype=float)
+    ratings = np.array([
+        product.rating if isinstance(product.rating, (int, float)) else np.nan
+        for product in products
+    ], dtype=float)
+    
+    query_terms = normalize_product_name(product_name).split()
+    if query_terms:
+        title_terms = [set(re.sub(r'[^\w\s]', ' ', product.title.lower()).split()) for product in products]
+        matches = np.array([[term in terms for term in query_terms] for terms in title_terms], dtype=float)
+        relevance = matches.mean(axis=1)
+    else:
+        relevance = np.zeros(len(products))
+    
+    rating = np.where(np.isnan(ratings), 0.5, ratings / 5)
+    budget_fit = np.clip(1 - np.abs(budget - prices) / budget, 0, 1) if budget > 0 else np.zeros(len(products))
+    price_span = prices.max() - prices.min()
+    value = 1 - (prices - prices.min()) / price_span if price_span > 0 else np.ones(len(products))
+    
+    scores = (
+        RANKING_WEIGHTS["relevance"] * relevance
+        + RANKING_WEIGHTS["rating"] * rating
+        + RANKING_WEIGHTS["budget_fit"] * budget_fit
+        + RANKING_WEIGHTS["value"] * value
+    )
+    
+    order = np.argsort(-scores, kind="stable")
+    return [replace(products[i], score=round(float(scores[i]), 3)) for i in order]
+
+def local_recommendations(ranked_products: List[Product], count: int = 3) -> List[Dict[str, Any]]:
+    """Turn the top of a rank_products result into recommendations without the LLM"""
+    return [
+        recommendation(i, product, f"Ranked #{i} on relevance, rating and price (score {product.score:.2f})")
+        for i, product in enumerate(ranked_products[:count], 1)
+    ]
+
+def recommendation(rank: int, product: Product, why: str) -> Dict[str, Any]:
+    """The recommendation dict returned to callers for one product"""
+    return {
+        "rank": rank,
+        "name": product.title,
+        "price": product.price,
+        "rating": product.rating,
+        "url": product.url,
+        "source": product.source,
+        "offers": [offer._asdict() for offer in product.offers],
+        "why_recommended": why,
+    }
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count: about one per 4 characters of a word, one per symbol"""
+    return sum(-(-len(piece) // 4) for piece in re.findall(r"\w+|[^\w\s]", text))
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Keep leading words of ``text`` while the estimate stays within ``max_tokens``"""
+    words = []
+    used = 0
+    for word in text.split():
+        cost = estimate_tokens(word)
+        if used + cost > max_tokens:
+            break
+        words.append(word)
+        used += cost
+    return " ".join(words)
+
+ANALYSIS_PROMPT_HEAD = """You are a product recommendation expert. Pick the top 3 products for the shopper's query: "{query}"
+Weigh relevance to the query, price-to-value, customer ratings and features named in the title.
+Products (id|title|price ₹|rating|ratings count|stores):"""
+
+ANALYSIS_PROMPT_TAIL = """Reply with only a JSON array, best first, at most 3 items: [{"id": "P1", "why": "one short sentence"}]"""
+
+def build_analysis_prompt(user_query: str, products: List[Product], title_tokens: int = 24,
+                          max_tokens: int = 1200) -> Tuple[str, Dict[str, Product]]:
+    """Encode candidates as compact table rows with short IDs, within a hard token ceiling
+    
+    Titles lose their punctuation and are cut to ``title_tokens``; rows are
+    added best first until the next one would push the prompt past
+    ``max_tokens``. Returns the prompt and the ID -> product map used to
+    rehydrate the model's answer.
+    """
+    # A very long query must not crowd out the products
+    query = trim_to_tokens(user_query, max_tokens // 4)
+    head = ANALYSIS_PROMPT_HEAD.format(query=query)
+    used = estimate_tokens(head) + estimate_tokens(ANALYSIS_PROMPT_TAIL)
+    
+    rows = []
+    candidates = {}
+    for i, product in enumerate(products, 1):
+        product_id = f"P{i}"
+        title = trim_to_tokens(re.sub(r"[^\w\s.+-]", " ", product.title), title_tokens)
+        rating = f"{product.rating:g}" if isinstance(product.rating, (int, float)) else "-"
+        stores = ",".join(dict.fromkeys(offer.source for offer in product.offers)) or product.source
+        row = f"{product_id}|{title}|{product.price:.0f}|{rating}|{product.reviews_count or '-'}|{stores}"
+        
+        cost = estimate_tokens(row)
+        if used + cost > max_tokens:
+            break
+        rows.append(row)
+        candidates[product_id] = product
+        used += cost
+    
+    return "\n".join([head, *rows, ANALYSIS_PROMPT_TAIL]), candidates
+
+def parse_analysis_response(response_text: str, candidates: Dict[str, Product], count: int = 3) -> List[Dict[str, Any]]:
+    """Rehydrate the model's [{"id", "why"}] answer into full recommendations
+    
+    Unknown and repeated IDs are skipped; an unusable answer gives an empty list.
+    """
+    json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
+    if not json_match:
+        return []
+    try:
+        picks = json.loads(json_match.group())
+    except json.JSONDecodeError:
+        return []
+    
+    recommendations = []
+    seen = set()
+    for pick in picks if isinstance(picks, list) else []:
+        if not isinstance(pick, dict):
+            continue
+        product_id = str(pick.get("id", "")).strip().upper()
+        if product_id not in candidates or product_id in seen:
+            continue
+        seen.add(product_id)
+        recommendations.append(recommendation(len(recommendations) + 1, candidates[product_id], str(pick.get("why", ""))))
+        if len(recommendations) == count:
+            break
+    return recommendations
+
+# MinHash settings for duplicate detection: BANDS x ROWS hash functions. Two
+# titles become candidates when any band of their signatures is identical,
+# which is likely above a Jaccard similarity of about (1 / BANDS) ** (1 / ROWS).
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+MINHASH_PRIME = (1 << 31) - 1
+
+@functools.lru_cache(maxsize=None)
+def minhash_coefficients() -> Tuple["np.ndarray", "np.ndarray"]:
+    """The fixed random (a, b) of each MinHash function, drawn on first use"""
+    import numpy as np
+    rng = np.random.default_rng(17)
+    return (
+        rng.integers(1, MINHASH_PRIME, MINHASH_BANDS * MINHASH_ROWS, dtype=np.int64),
+        rng.integers(0, MINHASH_PRIME, MINHASH_BANDS * MINHASH_ROWS, dtype=np.int64),
+    )
+
+def title_tokens(title: str) -> frozenset:
+    """Comparable title tokens (see normalize_product_name)"""
+    return frozenset(normalize_product_name(title).split())
+
+def minhash_signature(tokens: frozenset) -> "np.ndarray":
+    """MinHash signature of a token set; equal positions estimate Jaccard similarity"""
+    import numpy as np
+    a, b = minhash_coefficients()
+    hashes = np.array([zlib.crc32(token.encode()) for token in tokens] or [0], dtype=np.int64)
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % MINHASH_PRIME).min(axis=1)
+
+def same_product(tokens: frozenset, other: frozenset, threshold: float) -> bool:
+    """Near-identical titles that also agree on every number (storage, RAM, model year...)"""
+    if {token for token in tokens if any(c.isdigit() for c in token)} != {
+        token for token in other if any(c.isdigit() for c in token)
+    }:
+        return False
+    return len(tokens & other) / len(tokens | other) >= threshold
+
+def dedupe_products(products: List[Product], threshold: float = 0.75) -> List[Product]:
+    """Merge listings of the same product, within and across retailers
+    
+    Titles are bucketed with MinHash LSH so only likely pairs are compared,
+    then confirmed by exact token Jaccard similarity. Each cluster is kept as
+    its cheapest listing, with the best rating and every listing in ``offers``.
+    """
+    if len(products) < 2:
+        return list(products)
+    
+    tokens = [title_tokens(product.title) for product in products]
+    parent = list(range(len(products)))
+    
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    buckets: Dict[Tuple[int, bytes], List[int]] = defaultdict(list)
+    for i, product_tokens in enumerate(tokens):
+        signature = minhash_signature(product_tokens)
+        for band in range(MINHASH_BANDS):
+            rows = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+            buckets[(band, rows.tobytes())].append(i)
+    
+    for members in buckets.values():
+        for position, i in enumerate(members):
+            for j in members[position + 1:]:
+                if find(i) != find(j) and same_product(tokens[i], tokens[j], threshold):
+                    parent[find(j)] = find(i)
+    
+    clusters: Dict[int, List[Product]] = defaultdict(list)
+    for i, product in enumerate(products):
+        clusters[find(i)].append(product)
+    
+    merged = []
+    for listings in clusters.values():
+        listings.sort(key=lambda listing: listing.price)
+        ratings = [listing.rating for listing in listings if isinstance(listing.rating, (int, float))]
+        offers = {}
+        for listing in listings:
+            for offer in listing.offers:
+                offers.setdefault(offer.url or (offer.source, offer.price), offer)
+        merged.append(replace(
+            listings[0],
+            rating=max(ratings) if ratings else listings[0].rating,
+            reviews_count=max((listing.reviews_count or 0 for listing in listings), default=0) or None,
+            offers=sorted(offers.values(), key=lambda offer: offer.price),
+        ))
+    return merged
+
+class ProductScraper:
+    def __init__(
+        self,
+        max_contexts: int = 2,
+        max_pages: int = 4,
+        page_max_uses: int = 20,
+        context_max_pages: int = 50,
+        memory_limit_mb: float = 512.0,
+        extraction_mode: str = "batch",
+        parse_workers: Optional[int] = None,
+        selector_stats: Optional[SelectorStats] = None,
+        readiness_policies: Optional[Dict[str, Dict[str, Any]]] = None,
+        block_resources: bool = True,
+        resource_policies: Optional[Dict[str, Dict[str, List[str]]]] = None,
+        http_first: bool = True,
+        http_timeout: float = 8.0,
+        http_min_success: float = 0.2,
+        http_probe_every: int = 10,
+        crawl_pages: int = 3,
+        page_concurrency: int = 2,
+        enough_candidates: int = 30,
+        base_urls: Optional[Dict[str, str]] = None,
+        price_filters: bool = True,
+        snapshots: Optional[SnapshotStore] = None,
+    ):
         self.playwright = None
         self.browser = None
         self.context = None
         
+        # Pool configuration
+        self.max_contexts = max_contexts
+        self.max_pages = max_pages
+        self.page_max_uses = page_max_uses
+        self.context_max_pages = context_max_pages
+        self.memory_limit_mb = memory_limit_mb
+        
+        # "batch" reads all cards in one page.evaluate call, "locator" walks
+        # the cards element by element, "html" snapshots the page and parses
+        # it in a worker process after the page is returned to the pool
+        self.extraction_mode = extraction_mode
+        self.parse_workers = parse_workers
+        self._parse_pool = None
+        
+        # Learned selector ordering shared by all extraction modes
+        self.selector_stats = selector_stats or SelectorStats()
+        
+        # Per-site overrides are merged over READINESS_POLICIES
+        self.readiness_policies = {
+            site: {**policy, **(readiness_policies or {}).get(site, {})}
+            for site, policy in READINESS_POLICIES.items()
+        }
+        
+        # Request blocking: each site's lists are merged over the defaults
+        self.block_resources = block_resources
+        policies = {**RESOURCE_POLICIES, **(resource_policies or {})}
+        self.resource_policies = {
+            site: {
+                key: policies["default"].get(key, []) + (policy.get(key, []) if site != "default" else [])
+                for key in ("block_types", "deny_domains", "allow_domains")
+            }
+            for site, policy in policies.items()
+        }
+        self._page_sites: Dict[Any, str] = {}
+        self.request_stats = {
+            "allowed": 0,
+            "allowed_bytes": 0,
+            "blocked": 0,
+            "blocked_by_type": defaultdict(int),
+            "blocked_by_site": defaultdict(int),
+        }
+        
+        # Plain HTTP fetches tried before the browser. A site whose success
+        # ratio drops below http_min_success is only probed every
+        # http_probe_every searches until it recovers.
+        self.http_first = http_first
+        self.http_timeout = http_timeout
+        self.http_min_success = http_min_success
+        self.http_probe_every = http_probe_every
+        self._http_client = None
+        self.http_stats: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"attempts": 0, "successes": 0, "skipped": 0, "success_ratio": 1.0}
+        )
+        
+        # Result pages crawled per search (see crawl_search_pages)
+        self.crawl_pages = crawl_pages
+        self.page_concurrency = page_concurrency
+        self.enough_candidates = enough_candidates
+        
+        # Where search requests go, per site (e.g. a local fixture server for benchmarks)
+        self.base_urls = {
+            site: (base_urls or {}).get(site, config["base_url"]).rstrip("/")
+            for site, config in SITE_SELECTORS.items()
+        }
+        # Ask the retailers for in-budget results only (see SEARCH_URLS)
+        self.price_filters = price_filters
+        
+        # Optional: keep every fetched results page for later re-extraction
+        self.snapshots = snapshots
+        
+        # Pool state
+        self._contexts: List[Any] = []
+        self._context_pages: Dict[Any, int] = {}
+        self._idle_pages: List[Any] = []
+        self._page_uses: Dict[Any, int] = {}
+        self._page_slots = asyncio.Semaphore(max_pages)
+        self._lock = asyncio.Lock()
+        self._next_context = 0
+        
     async def initialize(self):
-        """Initialize Playwright browser"""
-        self.playwright = await async_playwright().start()
-        self.browser = await self.playwright.chromium.launch(headless=True)
-        self.context = await self.browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+        """Start Playwright and launch the shared browser if it is not running yet"""
+        async with self._lock:
+            if self.browser and self.browser.is_connected():
+                return
+            
+            if self.browser:
+                print("♻️  Browser disconnected, relaunching...")
+                await self._reset_pool()
+            
+            if not self.playwright:
+                from playwright.async_api import async_playwright
+                self.playwright = await async_playwright().start()
+            self.browser = await self.playwright.chromium.launch(headless=True)
+            self.context = await self._new_context()
+    
+    async def _new_context(self):
+        """Create a browser context and register it with the pool"""
+        context = await self.browser.new_context(user_agent=USER_AGENT)
+        if self.block_resources:
+            await context.route("**/*", self._route_request)
+            context.on("response", self._count_response)
+        self._contexts.append(context)
+        self._context_pages[context] = 0
+        return context
+    
+    def _site_for_request(self, request) -> str:
+        """Find which site's scrape issued a request ("default" if unknown)"""
+        try:
+            return self._page_sites.get(request.frame.page, "default")
+        except Exception:
+            # Service worker requests have no frame
+            return "default"
+    
+    async def _route_request(self, route):
+        """Abort requests the site's resource policy blocks and let the rest through"""
+        request = route.request
+        site = self._site_for_request(request)
+        policy = self.resource_policies.get(site, self.resource_policies["default"])
+        host = urlparse(request.url).hostname or ""
+        
+        blocked = not domain_matches(host, policy["allow_domains"]) and (
+            request.resource_type in policy["block_types"]
+            or domain_matches(host, policy["deny_domains"])
         )
         
-    async def close(self):
-        """Close browser and cleanup"""
-        if self.context:
-            await self.context.close()
+        if blocked:
+            self.request_stats["blocked"] += 1
+            self.request_stats["blocked_by_type"][request.resource_type] += 1
+            self.request_stats["blocked_by_site"][site] += 1
+            await route.abort()
+        else:
+            self.request_stats["allowed"] += 1
+            await route.continue_()
+    
+    def _count_response(self, response):
+        """Add a response's advertised size to the transferred byte counter"""
+        try:
+            self.request_stats["allowed_bytes"] += int(response.headers.get("content-length", 0))
+        except ValueError:
+            pass
+    
+    def resource_stats(self) -> Dict[str, Any]:
+        """Snapshot of the request blocking counters"""
+        return {
+            key: dict(value) if isinstance(value, defaultdict) else value
+            for key, value in self.request_stats.items()
+        }
+    
+    async def _reset_pool(self):
+        """Drop every pooled page and context (used when the browser dies)"""
+        for page in self._idle_pages:
+            self._page_uses.pop(page, None)
+        self._idle_pages = []
+        
+        for context in self._contexts:
+            try:
+                await context.close()
+            except Exception:
+                pass
+        self._contexts = []
+        self._context_pages = {}
+        self.context = None
+        
         if self.browser:
-            await self.browser.close()
-        if self.playwright:
-            await self.playwright.stop()
+            try:
+                await self.browser.close()
+            except Exception:
+                pass
+            self.browser = None
     
-    async def scrape_flipkart(self, search_term: str, budget: float) -> List[Dict]:
-        """Scrape Flipkart products with improved URL extraction"""
-        page = await self.context.new_page()
+    async def _pick_context(self):
+        """Return a context for a new page, recycling contexts that served too many pages
         
-        try:
-            query = quote_plus(search_term)
-            url = f"https://www.flipkart.com/search?q={query}&sort=price_asc"
-            
-            await page.goto(url, wait_until="domcontentloaded")
-            await page.wait_for_timeout(3000)
+        Callers must hold ``self._lock``.
+        """
+        for context in list(self._contexts):
+            if self._context_pages[context] >= self.context_max_pages:
+                await self._retire_context(context)
+        
+        if len(self._contexts) < self.max_contexts:
+            return await self._new_context()
+        
+        self._next_context = (self._next_context + 1) % len(self._contexts)
+        return self._contexts[self._next_context]
+    
+    async def _retire_context(self, context):
+        """Close a context once none of its pages are idle in the pool"""
+        self._contexts.remove(context)
+        self._context_pages.pop(context, None)
+        
+        stale_pages = [page for page in self._idle_pages if page.context == context]
+        for page in stale_pages:
+            self._idle_pages.remove(page)
+            self._page_uses.pop(page, None)
+        
+        if self.context == context:
+            self.context = self._contexts[0] if self._contexts else None
+        
+        # Pages still checked out keep the context alive until they are released
+        if not any(page.context == context for page in self._page_uses):
+            try:
+                await context.close()
+            except Exception:
+                pass
+    
+    async def _checkout_page(self):
+        """Take an idle page from the pool or open a new one
+        
+        Runs under the pool lock: otherwise concurrent checkouts could each see
+        room for another context, or retire a context another one is opening a page in.
+        """
+        async with self._lock:
+            while self._idle_pages:
+                page = self._idle_pages.pop()
+                if not page.is_closed():
+                    return page
+                self._page_uses.pop(page, None)
             
+            context = await self._pick_context()
+            page = await context.new_page()
+            self._context_pages[context] += 1
+            self._page_uses[page] = 0
+            return page
+    
+    async def _page_memory_mb(self, page) -> float:
+        """Read the JS heap size of a page in megabytes (0 when unavailable)"""
+        try:
+            used = await page.evaluate("() => performance.memory ? performance.memory.usedJSHeapSize : 0")
+            return used / (1024 * 1024)
+        except Exception:
+            return 0.0
+    
+    async def _release_page(self, page, healthy: bool):
+        """Return a page to the pool, or close it when it is worn out or unhealthy"""
+        self._page_uses[page] = self._page_uses.get(page, 0) + 1
+        
+        recycle = (
+            not healthy
+            or page.is_closed()
+            or self._page_uses[page] >= self.page_max_uses
+            or page.context not in self._context_pages
+            or await self._page_memory_mb(page) > self.memory_limit_mb
+        )
+        
+        if not recycle:
+            try:
+                await page.goto("about:blank")
+                self._idle_pages.append(page)
+                return
+            except Exception:
+                pass
+        
+        context = page.context
+        self._page_uses.pop(page, None)
+        try:
+            await page.close()
+        except Exception:
+            pass
+        
+        # Close retired contexts once their last page is gone
+        if context not in self._context_pages and not any(p.context == context for p in self._page_uses):
+            try:
+                await context.close()
+            except Exception:
+                pass
+    
+    @asynccontextmanager
+    async def page(self):
+        """Borrow a page from the pool for the duration of the block"""
+        await self.initialize()
+        
+        with METRICS.span("page_wait"):
+            await self._page_slots.acquire()
+        try:
+            page = await self._checkout_page()
+            healthy = True
+            try:
+                yield page
+            except BaseException:
+                healthy = False
+                raise
+            finally:
+                await self._release_page(page, healthy)
+        finally:
+            self._page_slots.release()
+    
+    async def warm_up(self):
+        """Launch the browser with one page ready, and start the HTTP client and parse workers"""
+        async def start_parse_workers():
+            # Workers are spawned on demand; a trivial task per worker brings them all up
+            parse_pool = self._get_parse_pool()
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*[
+                loop.run_in_executor(parse_pool, os.getpid) for _ in range(self.parse_workers or os.cpu_count() or 1)
+            ])
+        
+        async def open_first_page():
+            async with self.page():
+                pass
+        
+        self._get_http_client()
+        results = await asyncio.gather(start_parse_workers(), open_first_page(), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    
+    def browser_connected(self) -> bool:
+        """Whether the browser is up, without launching it (the next page checkout relaunches it)"""
+        try:
+            return self.browser is not None and self.browser.is_connected()
+        except Exception:
+            return False
+        
+    async def close(self):
+        """Close browser and cleanup"""
+        async with self._lock:
+            await self._reset_pool()
+            if self.playwright:
+                await self.playwright.stop()
+                self.playwright = None
+            if self._http_client:
+                await self._http_client.aclose()
+                self._http_client = None
+            if self._parse_pool:
+                await asyncio.to_thread(self._parse_pool.shutdown, wait=True, cancel_futures=True)
+                self._parse_pool = None
+            self.selector_stats.save()
+    
+    async def scrape_flipkart(self, search_term: str, budget: Optional[float] = None, products: Optional[List[Dict]] = None,
+                              target_budget: Optional[float] = None) -> List[Dict]:
+        """Scrape Flipkart products with improved URL extraction
+        
+        Products are appended to ``products`` as they are extracted, so a caller
+        that cancels the scrape still keeps whatever was collected so far. With
+        ``budget=None`` nothing is filtered out here, which is what the result cache
+        stores. ``target_budget`` goes into the search URL as a price filter (unless
+        ``price_filters`` is off) and decides when to stop reading cards and pages.
+        """
+        # Results are sorted by price, so reading stops at the first over-budget card
+        return await self.crawl_search_pages(
+            "Flipkart", self.search_url_builder("Flipkart", search_term, target_budget),
+            budget, products, target_budget, price_sorted=True
+        )
+    
+    def search_url_builder(self, site: str, search_term: str, target_budget: Optional[float]):
+        """Return a page number -> results URL function for one search"""
+        max_price = target_budget if self.price_filters else None
+        
+        def page_url(page_number: int) -> str:
+            return SEARCH_URLS[site](self.base_urls[site], search_term, page_number, max_price)
+        
+        return page_url
+    
+    async def crawl_search_pages(self, site: str, page_url, budget: Optional[float], products: Optional[List[Dict]],
+                                 target_budget: Optional[float], price_sorted: bool = False) -> List[Dict]:
+        """Scrape up to crawl_pages result pages, fetching pages 2..N concurrently
+        
+        Crawling stops early once ``enough_candidates`` products within
+        ``target_budget`` are collected or, on price-sorted listings, once a
+        page contains prices above it (every later page is pricier still).
+        Price-sorted pages also stop extracting at the first card above it.
+        """
+        if products is None:
             products = []
-            
-            # Try multiple selectors for Flipkart product cards
-            selectors = [
-                "[data-id]",
-                "._1AtVbE",
-                "._13oc-S",
-                "._1fQZEK",
-                ".s1Q9rs",
-                "._2kHMtA"
-            ]
-            
-            product_cards = None
-            for selector in selectors:
-                try:
-                    product_cards = page.locator(selector)
-                    count = await product_cards.count()
-                    if count > 0:
-                        print(f"Found {count} product cards with selector: {selector}")
-                        break
-                except Exception as e:
-                    continue
-            
-            if not product_cards or await product_cards.count() == 0:
-                print("No Flipkart products found")
-                return []
-            
-            card_count = await product_cards.count()
-            for i in range(min(card_count, 20)):
-                try:
-                    card = product_cards.nth(i)
-                    product_info = await self.extract_flipkart_product_info(card)
+        
+        def in_target(product):
+            return within_budget(product, target_budget)
+        
+        def page_exceeds_budget(page_products):
+            return price_sorted and target_budget is not None and any(not in_target(p) for p in page_products)
+        
+        def enough():
+            return target_budget is not None and sum(1 for p in products if in_target(p)) >= self.enough_candidates
+        
+        stop_above = target_budget if price_sorted else None
+        
+        # Page 1 streams straight into the caller's list
+        already_collected = len(products)
+        await self.scrape_search_page(site, page_url(1), budget, products, stop_above)
+        first_page = products[already_collected:]
+        if self.crawl_pages <= 1 or not first_page or page_exceeds_budget(first_page) or enough():
+            return products
+        
+        semaphore = asyncio.Semaphore(self.page_concurrency)
+        
+        async def scrape_page(page_number: int) -> List[Dict]:
+            async with semaphore:
+                # Products reach the caller's list as they are extracted, so a
+                # timed-out crawl keeps cards from pages that never finished
+                page_products = []
+                await self.scrape_search_page(site, page_url(page_number), budget, products, stop_above,
+                                              on_product=page_products.append)
+                return page_products
+        
+        pending = {
+            asyncio.create_task(scrape_page(page_number)): page_number
+            for page_number in range(2, self.crawl_pages + 1)
+        }
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    page_number = pending.pop(task)
+                    page_products = task.result()
                     
-                    if product_info and product_info.get('price') is not None:
-                        if product_info['price'] <= budget:
-                            product_info['source'] = 'Flipkart'
-                            products.append(product_info)
+                    if page_exceeds_budget(page_products):
+                        # Later pages can only be more expensive
+                        for other, other_number in list(pending.items()):
+                            if other_number > page_number:
+                                other.cancel()
+                                pending.pop(other)
                 
-                except Exception as e:
-                    print(f"Error extracting product {i}: {e}")
-                    continue
-            
+                if enough():
+                    print(f"Collected enough {site} candidates, skipping remaining pages")
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        return products
+    
+    async def scrape_search_page(self, site: str, url: str, budget: Optional[float] = None, products: Optional[List[Dict]] = None,
+                                 stop_above: Optional[float] = None,
+                                 on_product: Optional[Callable[[Dict], None]] = None) -> List[Dict]:
+        """Load a search results page and extract the products within budget (if given)
+        
+        A plain HTTP fetch is tried first; the browser is only used when the
+        static HTML has no product cards or is a bot check. On price-sorted
+        pages, ``stop_above`` ends extraction after the first card priced above it.
+        ``on_product`` is called with each product as it is added to ``products``.
+        """
+        if products is None:
+            products = []
+        
+        if self.should_try_http(site):
+            if await self.scrape_search_page_http(site, url, budget, products, stop_above, on_product):
+                return products
+        
+        html = None
+        snapshot = None
+        page_products = None
+        response_waiters = []
+        async with self.page() as page:
+            self._page_sites[page] = site
+            try:
+                # Response waiters must exist before navigation starts
+                response_waiters = self.expect_responses(page, site)
+                with METRICS.span("goto", site=site):
+                    await page.goto(url, wait_until="domcontentloaded")
+                with METRICS.span("wait_ready", site=site):
+                    await self.wait_for_results(page, site, response_waiters)
+                await self._share_cookies(page)
+                
+                if self.extraction_mode == "html":
+                    html = await page.content()
+                else:
+                    # Only read here: compressing and storing waits until the page is back in the pool
+                    remembered = None
+                    if self.snapshots is not None:
+                        snapshot = await page.content()
+                        remembered = await self.remembered_products(site, snapshot)
+                    if remembered is not None:
+                        self.collect_products(products, remembered, budget, stop_above, on_product)
+                    else:
+                        page_products = await self.extract_from_page(page, site, budget, products, stop_above, on_product)
+                
+            except Exception as e:
+                print(f"{site} scraping error: {e}")
+                return products
+            finally:
+                for waiter in response_waiters:
+                    waiter.cancel()
+                self._page_sites.pop(page, None)
+        
+        if html is None:
+            if snapshot is not None:
+                digest = await asyncio.to_thread(self.snapshots.put, site, url, snapshot)
+                if page_products is not None:
+                    await asyncio.to_thread(
+                        self.snapshots.save_products, digest, extractor_version(site), page_products
+                    )
             return products
+        
+        # The page is already back in the pool; parse the snapshot off the event loop
+        self.collect_products(products, await self.parse_html(html, site, url), budget, stop_above, on_product)
+        return products
+    
+    def should_try_http(self, site: str) -> bool:
+        """Decide whether to try the static HTTP path for a site, based on its track record"""
+        if not self.http_first:
+            return False
+        stats = self.http_stats[site]
+        if stats["success_ratio"] >= self.http_min_success:
+            return True
+        stats["skipped"] += 1
+        return stats["skipped"] % self.http_probe_every == 0
+    
+    def _record_http_result(self, site: str, success: bool):
+        """Update the site's exponentially weighted HTTP success ratio"""
+        stats = self.http_stats[site]
+        stats["attempts"] += 1
+        stats["successes"] += int(success)
+        stats["success_ratio"] = 0.8 * stats["success_ratio"] + 0.2 * float(success)
+    
+    def _get_http_client(self):
+        """Create the shared keep-alive HTTP/2 client on first use"""
+        if self._http_client is None:
+            import httpx
             
-        except Exception as e:
-            print(f"Flipkart scraping error: {e}")
-            return []
-        finally:
-            await page.close()
+            self._http_client = httpx.AsyncClient(
+                http2=True,
+                follow_redirects=True,
+                timeout=self.http_timeout,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+                headers={
+                    "User-Agent": USER_AGENT,
+                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+                    "Accept-Language": "en-IN,en;q=0.9",
+                    "Accept-Encoding": "gzip, deflate",
+                },
+            )
+        return self._http_client
+    
+    async def scrape_search_page_http(self, site: str, url: str, budget: Optional[float], products: List[Dict],
+                                      stop_above: Optional[float] = None,
+                                      on_product: Optional[Callable[[Dict], None]] = None) -> bool:
+        """Fetch and parse a results page without the browser; returns False to fall back"""
+        import httpx
+        
+        try:
+            with METRICS.span("http_fetch", site=site):
+                response = await self._get_http_client().get(url)
+                html = response.text
+        except httpx.HTTPError as e:
+            print(f"{site} HTTP fetch failed: {e}")
+            self._record_http_result(site, False)
+            return False
+        
+        lowered = html.lower()
+        if response.status_code != 200 or any(marker in lowered for marker in BOT_CHECK_MARKERS):
+            print(f"{site} static fetch blocked (HTTP {response.status_code}), using the browser")
+            self._record_http_result(site, False)
+            return False
+        
+        site_products = await self.parse_html(html, site, url)
+        self._record_http_result(site, bool(site_products))
+        if not site_products:
+            print(f"{site} static HTML has no product cards, using the browser")
+            return False
+        
+        self.collect_products(products, site_products, budget, stop_above, on_product)
+        return True
+    
+    async def _share_cookies(self, page):
+        """Copy browser cookies (e.g. passed bot checks) into the HTTP client's jar"""
+        if not self.http_first:
+            return
+        client = self._get_http_client()
+        for cookie in await page.context.cookies():
+            client.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"])
+    
+    def expect_responses(self, page, site: str) -> List[asyncio.Future]:
+        """Start waiting for the network responses the site's readiness policy needs"""
+        policy = self.readiness_policies[site]
+        waiters = []
+        for pattern in policy["responses"]:
+            waiters.append(asyncio.ensure_future(page.wait_for_event(
+                "response",
+                predicate=lambda response, pattern=pattern: pattern in response.url,
+                timeout=policy["max_wait_ms"]
+            )))
+        return waiters
+    
+    async def wait_for_results(self, page, site: str, response_waiters: Optional[List[asyncio.Future]] = None):
+        """Wait until the product cards have rendered, up to the policy's hard cap"""
+        policy = self.readiness_policies[site]
+        started = time.monotonic()
+        
+        cards_stable = asyncio.ensure_future(page.wait_for_function(
+            CARDS_STABLE_JS,
+            arg=[", ".join(SITE_SELECTORS[site]["cards"]), policy["stable_ms"]],
+            polling=policy["poll_ms"],
+            timeout=policy["max_wait_ms"]
+        ))
+        signals = [cards_stable] + (response_waiters or [])
+        
+        done, pending = await asyncio.wait(signals, timeout=policy["max_wait_ms"] / 1000)
+        for signal in pending:
+            signal.cancel()
+        
+        elapsed_ms = (time.monotonic() - started) * 1000
+        if pending or any(signal.exception() for signal in done):
+            print(f"{site} page not fully ready after {elapsed_ms:.0f}ms, extracting anyway")
+        else:
+            print(f"{site} page ready in {elapsed_ms:.0f}ms")
+    
+    async def extract_from_page(self, page, site: str, budget: Optional[float], products: List[Dict],
+                                stop_above: Optional[float] = None,
+                                on_product: Optional[Callable[[Dict], None]] = None) -> Optional[List[Dict[str, Any]]]:
+        """Extract products from the live page DOM, up to the first card above ``stop_above``
+        
+        Returns every product extracted from the page, or None when there were
+        no cards or extraction stopped early.
+        """
+        # Try multiple selectors for product cards, best known first
+        product_cards = None
+        card_selector = None
+        for selector in self.selector_stats.order(site, "cards", SITE_SELECTORS[site]["cards"]):
+            try:
+                product_cards = page.locator(selector)
+                count = await product_cards.count()
+                if count > 0:
+                    print(f"Found {count} {site} product cards with selector: {selector}")
+                    card_selector = selector
+                    break
+            except Exception:
+                continue
+        
+        self.selector_stats.record(site, "cards", card_selector)
+        if card_selector is None:
+            print(f"No {site} products found")
+            return None
+        
+        if self.extraction_mode == "batch":
+            site_products = await self.extract_cards_batch(product_cards, site)
+            self.collect_products(products, site_products, budget, stop_above, on_product)
+            return site_products
+        
+        extract_product_info = {
+            "Flipkart": self.extract_flipkart_product_info,
+            "Amazon": self.extract_amazon_product_info,
+        }[site]
+        fields = self.selector_stats.ordered_fields(site)
+        selectors = {field: spec["selectors"] for field, spec in fields.items()}
+        
+        site_products = []
+        card_count = min(await product_cards.count(), MAX_CARDS_PER_PAGE)
+        for i in range(card_count):
+            try:
+                card = product_cards.nth(i)
+                hits = {}
+                with METRICS.span("extract_card", site=site, mode="locator"):
+                    product_info = await extract_product_info(card, selectors, hits)
+                for name in ("url", "title", "price", "rating"):
+                    self.selector_stats.record(site, name, hits.get(name))
+                
+                if product_info and product_info.get('price') is not None:
+                    product_info['source'] = site
+                    METRICS.inc("cards_extracted_total", site=site)
+                    site_products.append(product_info)
+                    self.collect_product(products, product_info, budget, on_product)
+                    
+                    # Price-sorted: every remaining card is over budget too
+                    if stop_above is not None and product_info['price'] > stop_above:
+                        METRICS.inc("cards_skipped_total", card_count - i - 1, site=site)
+                        return None
+                else:
+                    METRICS.inc("cards_dropped_total", site=site)
+            
+            except Exception as e:
+                print(f"Error extracting {site} product {i}: {e}")
+                continue
+        return site_products
+    
+    def collect_products(self, products: List[Dict], site_products: List[Dict[str, Any]], budget: Optional[float],
+                         stop_above: Optional[float] = None, on_product: Optional[Callable[[Dict], None]] = None):
+        """Collect a page's extracted products in order, up to the first one above ``stop_above``"""
+        for product_info in site_products:
+            self.collect_product(products, product_info, budget, on_product)
+            if stop_above is not None and product_info['price'] > stop_above:
+                break
+    
+    def collect_product(self, products: List[Dict], product_info: Dict[str, Any], budget: Optional[float],
+                        on_product: Optional[Callable[[Dict], None]] = None):
+        """Add an extracted product to the results and announce it to any stream_query listener"""
+        if within_budget(product_info, budget):
+            products.append(product_info)
+            if on_product is not None:
+                on_product(product_info)
+            emit_event("product", product=product_info)
+    
+    def _get_parse_pool(self) -> ProcessPoolExecutor:
+        """Create the HTML parsing process pool on first use"""
+        if self._parse_pool is None:
+            # Spawned, not forked: forked workers would inherit the Playwright
+            # driver's pipes and keep playwright.stop() from ever returning
+            self._parse_pool = ProcessPoolExecutor(
+                max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn"), initializer=ignore_sigint
+            )
+        return self._parse_pool
+    
+    async def remembered_products(self, site: str, html: str) -> Optional[List[Dict[str, Any]]]:
+        """Products already extracted from this exact page with the current selector table, if any"""
+        products = await asyncio.to_thread(self.snapshots.products, snapshot_digest(html), extractor_version(site))
+        if products is not None:
+            METRICS.inc("snapshot_parse_skips_total", site=site)
+            print(f"Reused {len(products)} {site} products from an unchanged page")
+        return products
+    
+    async def parse_html(self, html: str, site: str, url: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Parse a results page snapshot in the worker process pool
+        
+        With a snapshot store the page is saved first, and a page already
+        parsed with the same selector table is not parsed again.
+        """
+        if self.snapshots is not None:
+            remembered = await self.remembered_products(site, html)
+            digest = await asyncio.to_thread(self.snapshots.put, site, url or "", html)
+            if remembered is not None:
+                return remembered
+        
+        card_selectors = self.selector_stats.order(site, "cards", SITE_SELECTORS[site]["cards"])
+        fields = self.selector_stats.ordered_fields(site)
+        parse_pool = self._get_parse_pool()
+        loop = asyncio.get_running_loop()
+        with METRICS.span("extract_cards", site=site, mode="html"):
+            card_selector, records = await loop.run_in_executor(
+                parse_pool, extract_search_records, html, card_selectors, fields, MAX_CARDS_PER_PAGE
+            )
+        self.selector_stats.record(site, "cards", card_selector)
+        
+        products = self.build_products(site, fields, records)
+        print(f"Parsed {len(products)}/{len(records)} {site} products from HTML")
+        if self.snapshots is not None:
+            await asyncio.to_thread(self.snapshots.save_products, digest, extractor_version(site), products)
+        return products
+    
+    async def extract_cards_batch(self, product_cards, site: str) -> List[Dict[str, Any]]:
+        """Extract up to MAX_CARDS_PER_PAGE cards in a single browser round trip"""
+        fields = self.selector_stats.ordered_fields(site)
+        with METRICS.span("extract_cards", site=site, mode="batch"):
+            records = await product_cards.evaluate_all(
+                EXTRACT_CARDS_JS,
+                [fields, MAX_CARDS_PER_PAGE, 8]
+            )
+        
+        products = self.build_products(site, fields, records)
+        print(f"Extracted {len(products)}/{len(records)} {site} products in one pass")
+        return products
+    
+    def build_products(self, site: str, fields: Dict[str, Dict], records: List[Dict[str, List]]) -> List[Dict[str, Any]]:
+        """Build products from raw card records and learn which selectors won"""
+        products = []
+        for record in records:
+            hits = {}
+            product_info = build_product(site, record, hits)
+            for name, spec in fields.items():
+                selector_index = hits.get(name)
+                self.selector_stats.record(
+                    site, name, spec["selectors"][selector_index] if selector_index is not None else None
+                )
+            if product_info:
+                products.append(product_info)
+        
+        METRICS.inc("cards_extracted_total", len(products), site=site)
+        METRICS.inc("cards_dropped_total", len(records) - len(products), site=site)
+        return products
     
-    async def extract_flipkart_product_info(self, card):
+    async def extract_flipkart_product_info(self, card, selectors: Optional[Dict[str, List[str]]] = None, hits: Optional[Dict[str, str]] = None):
         """Extract product information from Flipkart product card with improved URL extraction"""
         product_info = {
             'title': None,
@@ -119,17 +2491,15 @@ class ProductScraper:
             'url': None
         }
         
+        # Learned selector order from SelectorStats, and where to report which selector won
+        if selectors is None:
+            selectors = {field: spec["selectors"] for field, spec in FLIPKART_SELECTORS["fields"].items()}
+        if hits is None:
+            hits = {}
+        
         try:
             # Improved URL extraction for Flipkart
-            link_selectors = [
-                "a[href*='/p/']",
-                "a[title]",
-                "a[href]",
-                "._1fQZEK",
-                ".s1Q9rs",
-                "._4rR01T",
-                "._2WkVRV"
-            ]
+            link_selectors = selectors["url"]
             
             for selector in link_selectors:
                 try:
@@ -153,21 +2523,13 @@ class ProductScraper:
                             continue
                     
                     if product_info['url']:
+                        hits['url'] = selector
                         break
                 except Exception:
                     continue
             
             # Extract title with improved selectors
-            title_selectors = [
-                "._4rR01T",
-                ".s1Q9rs",
-                "._2WkVRV", 
-                ".IRpwTa",
-                "a[title]",
-                "._1fQZEK",
-                "a span",
-                "div[title]"
-            ]
+            title_selectors = selectors["title"]
             
             for selector in title_selectors:
                 try:
@@ -191,20 +2553,13 @@ class ProductScraper:
                             continue
                     
                     if product_info['title']:
+                        hits['title'] = selector
                         break
                 except Exception:
                     continue
             
             # Extract price with improved logic
-            price_selectors = [
-                "._30jeq3",
-                "._1_WHN1",
-                "._3tbHP2",
-                "._1vC4OE",
-                "._30jeq3._1_WHN1",
-                ".CEmiEU",
-                "._1_WHN1._30jeq3"
-            ]
+            price_selectors = selectors["price"]
             
             for selector in price_selectors:
                 try:
@@ -233,18 +2588,13 @@ class ProductScraper:
                             continue
                     
                     if product_info['price']:
+                        hits['price'] = selector
                         break
                 except Exception:
                     continue
             
             # Extract rating
-            rating_selectors = [
-                "._3LWZlK",
-                "._3LWZlK div",
-                "._3LWZlK span",
-                "[class*='rating']",
-                "._13vcmD"
-            ]
+            rating_selectors = selectors["rating"]
             
             for selector in rating_selectors:
                 try:
@@ -258,6 +2608,7 @@ class ProductScraper:
                                 rating_value = float(rating_match.group(1))
                                 if 0 <= rating_value <= 5:
                                     product_info['rating'] = rating_value
+                                    hits['rating'] = selector
                                     break
                 except Exception:
                     continue
@@ -276,48 +2627,17 @@ class ProductScraper:
             print(f"Error extracting Flipkart product info: {e}")
             return None
     
-    async def scrape_amazon(self, product_name: str, budget: float) -> List[Dict[str, Any]]:
-        """Scrape products from Amazon with improved URL extraction"""
-        page = await self.context.new_page()
+    async def scrape_amazon(self, product_name: str, budget: Optional[float] = None, products: Optional[List[Dict[str, Any]]] = None,
+                            target_budget: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Scrape products from Amazon with improved URL extraction
         
-        try:
-            # Search for products
-            search_query = product_name.replace(" ", "+")
-            url = f"https://www.amazon.in/s?k={search_query}"
-            
-            await page.goto(url, wait_until="domcontentloaded")
-            await page.wait_for_selector("div[data-component-type='s-search-result']", timeout=15000)
-            await page.wait_for_timeout(2000)
-            
-            products = []
-            product_cards = page.locator("div[data-component-type='s-search-result']")
-            
-            card_count = await product_cards.count()
-            print(f"Found {card_count} Amazon product cards")
-            
-            for i in range(min(card_count, 20)):
-                try:
-                    card = product_cards.nth(i)
-                    product_info = await self.extract_amazon_product_info(card)
-                    
-                    if product_info and product_info.get('price') is not None:
-                        if product_info['price'] <= budget:
-                            product_info['source'] = 'Amazon'
-                            products.append(product_info)
-                
-                except Exception as e:
-                    print(f"Error extracting Amazon product {i}: {e}")
-                    continue
-            
-            return products
-            
-        except Exception as e:
-            print(f"Amazon scraping error: {e}")
-            return []
-        finally:
-            await page.close()
+        Products are appended to ``products`` as they are extracted (see scrape_flipkart).
+        """
+        return await self.crawl_search_pages(
+            "Amazon", self.search_url_builder("Amazon", product_name, target_budget), budget, products, target_budget
+        )
     
-    async def extract_amazon_product_info(self, card):
+    async def extract_amazon_product_info(self, card, selectors: Optional[Dict[str, List[str]]] = None, hits: Optional[Dict[str, str]] = None):
         """Extract product information from Amazon product card with improved URL extraction"""
         product_info = {
             'title': None,
@@ -330,16 +2650,15 @@ class ProductScraper:
             'url': None
         }
         
+        # Learned selector order from SelectorStats, and where to report which selector won
+        if selectors is None:
+            selectors = {field: spec["selectors"] for field, spec in AMAZON_SELECTORS["fields"].items()}
+        if hits is None:
+            hits = {}
+        
         try:
             # Improved URL extraction for Amazon
-            link_selectors = [
-                "h2 a[href]",
-                "a[href*='/dp/']",
-                "a[href*='/gp/product/']",
-                ".a-link-normal[href]",
-                "a[data-component-type='s-product-image']",
-                ".s-image[href]"
-            ]
+            link_selectors = selectors["url"]
             
             for selector in link_selectors:
                 try:
@@ -363,21 +2682,13 @@ class ProductScraper:
                             continue
                     
                     if product_info['url']:
+                        hits['url'] = selector
                         break
                 except Exception:
                     continue
             
             # Extract title
-            title_selectors = [
-                "div[data-cy='title-recipe'] h2.a-size-base-plus span",
-                "div[data-cy='title-recipe'] h2 span",
-                "h2.a-size-mini a span",
-                "h2.a-size-mini span",
-                "h2 a span",
-                "h2 span",
-                ".a-size-base-plus",
-                ".a-size-medium"
-            ]
+            title_selectors = selectors["title"]
             
             for selector in title_selectors:
                 try:
@@ -398,17 +2709,13 @@ class ProductScraper:
                             continue
                     
                     if product_info['title']:
+                        hits['title'] = selector
                         break
                 except Exception:
                     continue
             
             # Extract rating
-            rating_selectors = [
-                "span[aria-label*='out of 5 stars']",
-                "span.a-icon-alt",
-                "div[data-cy='reviews-block'] span.a-size-small.a-color-base",
-                ".a-icon-alt"
-            ]
+            rating_selectors = selectors["rating"]
             
             for selector in rating_selectors:
                 try:
@@ -425,18 +2732,13 @@ class ProductScraper:
                                 rating_value = float(rating_match.group(1))
                                 if 0 <= rating_value <= 5:
                                     product_info['rating'] = rating_value
+                                    hits['rating'] = selector
                                     break
                 except Exception:
                     continue
             
             # Extract price
-            price_selectors = [
-                "span.a-price span.a-offscreen",
-                "span.a-price-whole",
-                ".a-price .a-offscreen",
-                ".a-price-range .a-price .a-offscreen",
-                ".a-price"
-            ]
+            price_selectors = selectors["price"]
             
             for selector in price_selectors:
                 try:
@@ -465,6 +2767,7 @@ class ProductScraper:
                             continue
                     
                     if product_info['price']:
+                        hits['price'] = selector
                         break
                 except Exception:
                     continue
@@ -480,25 +2783,127 @@ class ProductScraper:
             return None
 
 class ShoppingAgent:
-    def __init__(self):
-        # Configure Google Gemini
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        self.llm = genai.GenerativeModel('gemini-2.0-flash-exp')
-        self.scraper = ProductScraper()
-        self.graph = self.create_graph()
+    def __init__(self, site_timeout: float = 20.0, query_deadline: float = 30.0, cache: Optional[DiskCache] = None, use_cache: bool = True,
+                 use_llm: bool = True, rerank_top_k: int = 10, scrape_concurrency: int = 4, llm_concurrency: int = 4,
+                 profile_dir: Optional[str] = None, scraper: Optional[ProductScraper] = None,
+                 prompt_title_tokens: int = 24, max_prompt_tokens: int = 1200, max_output_tokens: int = 256,
+                 speculate: bool = True, llm_client: Optional[LLMClient] = None):
+        # The Gemini client and the graph are built on first use (see warm_up),
+        # so creating an agent does not pay for their imports
+        self._graph = None
+        self._build_lock = threading.Lock()
+        self.scraper = scraper or ProductScraper()
+        
+        # Concurrent queries share the client's LLM call limit
+        self.llm_client = llm_client or LLMClient(concurrency=llm_concurrency)
+        
+        # Each retailer runs as its own graph branch
+        self.sites = {
+            "Flipkart": self.scraper.scrape_flipkart,
+            "Amazon": self.scraper.scrape_amazon,
+        }
+        self.site_timeout = site_timeout
+        self.query_deadline = query_deadline
+        
+        # Raw per-site results, reused across budgets until they expire
+        self.cache = cache or (DiskCache() if use_cache else None)
+        
+        # LLM query parses: an in-memory LRU in front of the disk cache
+        self._parse_memo: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.parse_memo_size = 256
+        self.parse_memo_ttl = 7 * 24 * 3600
+        
+        # Start searching for a locally guessed product term while the LLM parses
+        self.speculate = speculate
+        
+        # Local pre-ranking: how many candidates the LLM sees, or skip it entirely
+        self.use_llm = use_llm
+        self.rerank_top_k = rerank_top_k
+        
+        # Analysis prompt size: per-title trim, hard ceiling on the prompt, cap on the answer
+        self.prompt_title_tokens = prompt_title_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_output_tokens = max_output_tokens
+        
+        # Concurrent queries share this, separately from the LLM client's limit
+        self.scrape_slots = asyncio.Semaphore(scrape_concurrency)
+        
+        # Concurrent duplicates share one run: whole queries, and per-site scrapes
+        self._query_flight = SingleFlight()
+        self._scrape_flight = SingleFlight()
+        # Price cap of the search ahead running for each cache key
+        self._search_ahead_caps: Dict[str, float] = {}
+        
+        # Opt-in: write every query's span log to this directory
+        self.profile_dir = profile_dir
+    
+    @property
+    def llm(self):
+        """The LLM client's model backend, configured on first use"""
+        return self.llm_client.backend
+    
+    @llm.setter
+    def llm(self, model):
+        self.llm_client.backend = model
+    
+    @property
+    def graph(self):
+        """The compiled workflow, built on first use"""
+        with self._build_lock:
+            if self._graph is None:
+                self._graph = self.create_graph()
+            return self._graph
+    
+    async def warm_up(self):
+        """Get everything the first query needs ready in the background
+        
+        Imports and builds the graph and the Gemini client, opens the model
+        API connection, launches the browser with a page waiting in the pool
+        and starts the parse workers. Failures are only reported: the first
+        query will simply retry whatever did not come up.
+        """
+        started = time.perf_counter()
+        
+        async def warm_llm():
+            await asyncio.to_thread(lambda: self.graph)
+            await self.llm_client.warm_up()
+        
+        async def warm(part: str, coroutine):
+            try:
+                await coroutine
+            except Exception as e:
+                print(f"⚠️ {part} warm-up failed, will retry on first query: {e}")
+        
+        await asyncio.gather(
+            warm("LLM", warm_llm()),
+            warm("Browser", self.scraper.warm_up()),
+        )
+        METRICS.observe("warm_up_seconds", time.perf_counter() - started)
         
-    def create_graph(self) -> StateGraph:
+    def create_graph(self):
         """Create the LangGraph workflow"""
+        from langgraph.graph import StateGraph, END
+        
         workflow = StateGraph(AgentState)
         
         # Add nodes
-        workflow.add_node("parse_query", self.parse_query)
-        workflow.add_node("scrape_products", self.scrape_products)
-        workflow.add_node("analyze_products", self.analyze_products)
+        workflow.add_node("parse_query", self.timed_node("parse_query", self.parse_query))
+        workflow.add_node("scrape_products", self.timed_node("scrape_products", self.scrape_products))
+        workflow.add_node("dedupe_products", self.timed_node("dedupe_products", self.dedupe_products))
+        workflow.add_node("analyze_products", self.timed_node("analyze_products", self.analyze_products))
+        
+        site_nodes = []
+        for site in self.sites:
+            node_name = f"scrape_{site.lower()}"
+            workflow.add_node(node_name, self.timed_node(node_name, self.create_site_node(site)))
+            site_nodes.append(node_name)
         
-        # Add edges
+        # Add edges: fan out to every site, fan back in to merge duplicates before analysis
         workflow.add_edge("parse_query", "scrape_products")
-        workflow.add_edge("scrape_products", "analyze_products")
+        for node_name in site_nodes:
+            workflow.add_edge("scrape_products", node_name)
+        workflow.add_edge(site_nodes, "dedupe_products")
+        workflow.add_edge("dedupe_products", "analyze_products")
         workflow.add_edge("analyze_products", END)
         
         # Set entry point
@@ -506,10 +2911,123 @@ class ShoppingAgent:
         
         return workflow.compile()
     
+    def timed_node(self, name: str, node):
+        """Wrap a graph node so its wall-clock duration lands in state["timings"]"""
+        async def run(state: AgentState) -> AgentState:
+            with METRICS.span("node", node=name):
+                started = time.perf_counter()
+                update = await node(state)
+                elapsed = time.perf_counter() - started
+            return {**update, "timings": {name: round(elapsed, 3)}}
+        
+        return run
+    
     async def parse_query(self, state: AgentState) -> AgentState:
         """Parse user query to extract product name and budget"""
         print("🔍 Parsing your query...")
         
+        # Clearly structured queries ("headphones under 5k") skip the LLM entirely
+        parsed = parse_query_locally(state["user_query"])
+        if parsed:
+            print("⚡ Parsed locally")
+        elif self.speculate:
+            parsed = await self.parse_query_speculatively(state["user_query"])
+        else:
+            parsed = await self.parse_query_with_llm(state["user_query"])
+        
+        print(f"📱 Product: {parsed['product_name']}")
+        print(f"💰 Budget: ₹{parsed['budget']:,.0f}")
+        emit_event("parsed_query", product_name=parsed["product_name"], budget=parsed["budget"])
+        
+        return {"product_name": parsed["product_name"], "budget": parsed["budget"]}
+    
+    async def parse_query_speculatively(self, user_query: str) -> Dict[str, Any]:
+        """Parse with the LLM while the retailer searches start on a guessed product term
+        
+        The searches are capped at the largest price in the query, so they
+        cover whichever budget the LLM finds; they are kept when its product
+        name normalizes to the guess, and cancelled otherwise so the site
+        nodes search again for the real one. Queries naming no price are not
+        searched ahead: an uncapped search would not fit the capped ones.
+        Searches still running when the query ends are cancelled then.
+        """
+        term = guess_product_term(user_query)
+        ceiling = guess_budget_ceiling(user_query)
+        if term is None or ceiling is None or await self.recall_parse(user_query) is not None:
+            return await self.parse_query_with_llm(user_query)
+        
+        print(f"🏃 Searching ahead for: {term} (up to ₹{ceiling:,.0f})")
+        searches = [asyncio.create_task(self.search_ahead(site, term, ceiling)) for site in self.sites]
+        searches_ahead = _searches_ahead.get()
+        if searches_ahead is not None:
+            searches_ahead.extend(searches)
+        
+        try:
+            parsed = await self.parse_query_with_llm(user_query)
+        except BaseException:
+            for search in searches:
+                search.cancel()
+            raise
+        
+        if normalize_product_name(parsed["product_name"]) == normalize_product_name(term):
+            METRICS.inc("speculative_searches_total", outcome="kept")
+            print("🎯 Early searches match, keeping them")
+        else:
+            METRICS.inc("speculative_searches_total", outcome="cancelled")
+            print("↩️ Early searches were for the wrong product, restarting")
+            for search in searches:
+                search.cancel()
+        return parsed
+    
+    async def search_ahead(self, site: str, term: str, price_cap: float):
+        """Run a search for ``term`` capped at ``price_cap`` that a matching site node can join or read from the cache"""
+        # Tasks run in a copy of the caller's context: products reach the stream
+        # only when a site node joins this search, i.e. once it has been kept
+        _stream_events.set(None)
+        
+        cache_key = f"{site}:{normalize_product_name(term)}"
+        if self.cache:
+            entry = await asyncio.to_thread(self.cache.get, "search_results", cache_key)
+            if entry is not None and (entry["price_cap"] is None or price_cap <= entry["price_cap"]):
+                return
+        
+        state = {"product_name": term, "budget": price_cap, "scrape_deadline": time.monotonic() + self.query_deadline}
+        self._search_ahead_caps[cache_key] = price_cap
+        try:
+            await self._scrape_flight.do(
+                (cache_key, price_cap), lambda: self.scrape_and_cache(site, state, cache_key, price_cap)
+            )
+        finally:
+            if self._search_ahead_caps.get(cache_key) == price_cap:
+                del self._search_ahead_caps[cache_key]
+    
+    async def settle_searches_ahead(self, searches: List[asyncio.Task]):
+        """Cancel a finished query's searches ahead that nothing joined, and report any that failed"""
+        for search in searches:
+            search.cancel()
+        for outcome in await asyncio.gather(*searches, return_exceptions=True):
+            if isinstance(outcome, Exception):
+                print(f"Search ahead failed: {outcome}")
+    
+    async def recall_parse(self, user_query: str) -> Optional[Dict[str, Any]]:
+        """Return a remembered LLM parse of the query, from memory or disk"""
+        memo_key = " ".join(user_query.lower().split())
+        
+        parsed = self._parse_memo.get(memo_key)
+        if parsed is None and self.cache:
+            parsed = await asyncio.to_thread(self.cache.get, "parse", memo_key, self.parse_memo_ttl)
+        if parsed is not None:
+            self._remember_parse(memo_key, parsed)
+        return parsed
+    
+    async def parse_query_with_llm(self, user_query: str) -> Dict[str, Any]:
+        """Ask the LLM to parse the query, memoizing successful parses in memory and on disk"""
+        memo_key = " ".join(user_query.lower().split())
+        
+        parsed = await self.recall_parse(user_query)
+        if parsed is not None:
+            return parsed
+        
         prompt = f"""
         You are a shopping assistant. Extract the product name and budget from the user's query.
         
@@ -527,179 +3045,214 @@ class ShoppingAgent:
         Convert k to thousands (30k = 30000).
         If no budget is mentioned, assume a reasonable budget based on the product type.
         
-        User query: {state["user_query"]}
+        User query: {user_query}
         """
         
         try:
-            response = await asyncio.to_thread(self.llm.generate_content, prompt)
-            response_text = response.text
+            response_text = await self.llm_client.generate(prompt, stage="parse_query")
             
             # Extract JSON from response
             json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
             if json_match:
                 parsed_data = json.loads(json_match.group())
-                state["product_name"] = parsed_data["product_name"]
-                state["budget"] = float(parsed_data["budget"])
-                
-                print(f"📱 Product: {state['product_name']}")
-                print(f"💰 Budget: ₹{state['budget']:,.0f}")
+                parsed = {
+                    "product_name": parsed_data["product_name"],
+                    "budget": float(parsed_data["budget"])
+                }
             else:
                 raise ValueError("No JSON found in response")
                 
         except Exception as e:
             print(f"Error parsing query: {e}")
-            # Fallback extraction
-            budget_match = re.search(r'(\d+)k?', state["user_query"], re.IGNORECASE)
+            # Fallback extraction (not memoized, so the LLM is retried next time)
+            budget_match = re.search(r'(\d+)k?', user_query, re.IGNORECASE)
             if budget_match:
                 budget = float(budget_match.group(1))
-                if 'k' in state["user_query"].lower():
+                if 'k' in user_query.lower():
                     budget *= 1000
-                state["budget"] = budget
             else:
-                state["budget"] = 50000  # Default budget
-                
-            state["product_name"] = state["user_query"]
+                budget = 50000  # Default budget
+            
+            return {"product_name": user_query, "budget": budget}
         
-        return state
+        self._remember_parse(memo_key, parsed)
+        if self.cache:
+            await asyncio.to_thread(self.cache.set, "parse", memo_key, parsed, self.parse_memo_ttl)
+        return parsed
+    
+    def _remember_parse(self, memo_key: str, parsed: Dict[str, Any]):
+        """Store a parse in the in-memory LRU"""
+        self._parse_memo[memo_key] = parsed
+        self._parse_memo.move_to_end(memo_key)
+        while len(self._parse_memo) > self.parse_memo_size:
+            self._parse_memo.popitem(last=False)
     
     async def scrape_products(self, state: AgentState) -> AgentState:
-        """Scrape products from e-commerce sites"""
+        """Start the per-site scraping branches and set the shared deadline"""
         print("🛒 Searching for products...")
         
-        await self.scraper.initialize()
+        # The browser pool stays warm across queries; this only launches it once.
+        # A failed launch is not fatal: the HTTP path may not need the browser.
+        try:
+            await self.scraper.initialize()
+        except Exception as e:
+            print(f"⚠️ Browser unavailable, relying on plain HTTP fetches: {e}")
+        
+        return {"scrape_deadline": time.monotonic() + self.query_deadline}
+    
+    def create_site_node(self, site: str):
+        """Build the graph node that scrapes a single retailer"""
+        async def scrape_site(state: AgentState) -> AgentState:
+            return {"scraped_products": await self.scrape_site(site, state)}
+        
+        return scrape_site
+    
+    async def scrape_site(self, site: str, state: AgentState) -> List[Dict[str, Any]]:
+        """Return one retailer's in-budget products, from the cache or a bounded live scrape"""
+        print(f"  📦 Searching {site}...")
         
-        all_products = []
+        cache_key = f"{site}:{normalize_product_name(state['product_name'])}"
+        entry = None
+        if self.cache:
+            entry = await asyncio.to_thread(self.cache.get, "search_results", cache_key)
         
-        # Scrape from Flipkart
-        print("  📦 Searching Flipkart...")
-        try:
-            flipkart_products = await self.scraper.scrape_flipkart(
-                state["product_name"], 
-                state["budget"]
+        # Live searches are cut off at their budget (the entry's price cap), so they
+        # only answer equal or lower budgets; uncapped entries (searches ahead) answer any
+        if entry is not None and (entry["price_cap"] is None or state["budget"] <= entry["price_cap"]):
+            print(f"  ⚡ Using cached {site} results")
+            products = entry["products"]
+            for product in products:
+                emit_event("product", product=product)
+        else:
+            # Searches are price-filtered and stop reading at the budget, so their results
+            # are capped at it and only equal budgets can share one in flight. A search
+            # ahead capped at a higher price also covers this budget.
+            price_cap = state["budget"]
+            ahead_cap = self._search_ahead_caps.get(cache_key)
+            if ahead_cap is not None and price_cap <= ahead_cap and self._scrape_flight.running((cache_key, ahead_cap)):
+                price_cap = ahead_cap
+            products, shared = await self._scrape_flight.do(
+                (cache_key, price_cap), lambda: self.scrape_and_cache(site, state, cache_key, price_cap)
             )
-            all_products.extend(flipkart_products)
-            print(f"  ✅ Found {len(flipkart_products)} products from Flipkart")
-        except Exception as e:
-            print(f"  ❌ Flipkart search failed: {e}")
+            if shared:
+                print(f"  🔗 Joined an in-progress {site} search")
+                for product in products:
+                    emit_event("product", product=product)
         
-        # Scrape from Amazon
-        print("  📦 Searching Amazon...")
-        try:
-            amazon_products = await self.scraper.scrape_amazon(
-                state["product_name"], 
-                state["budget"]
+        in_budget = [product for product in products if within_budget(product, state["budget"])]
+        print(f"  ✅ Found {len(in_budget)} products from {site}")
+        return in_budget
+    
+    async def scrape_and_cache(self, site: str, state: AgentState, cache_key: str, price_cap: Optional[float]) -> List[Dict[str, Any]]:
+        """Run a live scrape and cache its results if it completed"""
+        products, complete = await self.scrape_site_live(site, state)
+        
+        # Only complete, non-empty scrapes are worth reusing
+        if self.cache and products and complete:
+            await asyncio.to_thread(
+                self.cache.set, "search_results", cache_key, {"products": products, "price_cap": price_cap}
             )
-            all_products.extend(amazon_products)
-            print(f"  ✅ Found {len(amazon_products)} products from Amazon")
-        except Exception as e:
-            print(f"  ❌ Amazon search failed: {e}")
+        return products
+    
+    async def scrape_site_live(self, site: str, state: AgentState) -> Tuple[List[Dict[str, Any]], bool]:
+        """Scrape one retailer, giving up at the per-site timeout or the query deadline
         
-        await self.scraper.close()
+        Returns the products collected and whether the scrape ran to completion.
+        """
+        products = []
         
-        state["scraped_products"] = all_products
-        print(f"  ✅ Total products found: {len(all_products)}")
+        async with self.scrape_slots:
+            # Time spent waiting for a slot still counts against the query deadline
+            remaining = state["scrape_deadline"] - time.monotonic()
+            timeout = max(0.0, min(self.site_timeout, remaining))
+            
+            try:
+                # No budget filter here: these results are what gets cached. The budget
+                # narrows the retailer's own search and says when to stop reading.
+                await asyncio.wait_for(
+                    self.sites[site](state["product_name"], None, products, target_budget=state["budget"]),
+                    timeout=timeout
+                )
+                return products, True
+            except asyncio.TimeoutError:
+                print(f"  ⏱️ {site} search timed out after {timeout:.0f}s, keeping {len(products)} products")
+            except Exception as e:
+                print(f"  ❌ {site} search failed: {e}")
         
-        return state
+        return products, False
+    
+    async def dedupe_products(self, state: AgentState) -> AgentState:
+        """Turn the scraped dicts into Product records, merging the same product across listings"""
+        print(f"  ✅ Total products found: {len(state['scraped_products'])}")
+        products = dedupe_products([Product.from_dict(product) for product in state["scraped_products"]])
+        if len(products) < len(state["scraped_products"]):
+            print(f"  🔗 {len(products)} distinct products after merging duplicate listings")
+        return {"products": products}
     
     async def analyze_products(self, state: AgentState) -> AgentState:
         """Analyze and rank products using LLM"""
         print("🤖 Analyzing products...")
         
-        if not state["scraped_products"]:
-            state["final_recommendations"] = []
-            return state
-        
-        # Prepare products for analysis
-        products_for_analysis = []
-        for product in state["scraped_products"]:
-            products_for_analysis.append({
-                "name": product["title"],
-                "price": product["price"],
-                "rating": product["rating"],
-                "url": product["url"],
-                "source": product["source"]
-            })
-        
-        products_json = json.dumps(products_for_analysis, indent=2)
+        if not state["products"]:
+            return {"final_recommendations": []}
         
-        prompt = f"""
-        You are a product recommendation expert. Analyze the following products and recommend the top 3 that best match the user's query: "{state['user_query']}"
-        
-        Consider these factors:
-        1. Relevance to the search query
-        2. Price-to-value ratio
-        3. Customer ratings (if available)
-        4. Product features mentioned in the name
-        
-        Products data:
-        {products_json}
-        
-        Return your response as a JSON array of the top 3 products with explanations:
-        [
-            {{
-                "rank": 1,
-                "name": "product name",
-                "price": price_number,
-                "rating": "rating_value",
-                "url": "product_url",
-                "source": "source_name",
-                "why_recommended": "brief explanation why this product is recommended"
-            }}
-        ]
+        # Score everything locally; only the best candidates go to the LLM
+        ranked_products = rank_products(state["products"], state["product_name"], state["budget"])
+        if not self.use_llm:
+            return {"final_recommendations": local_recommendations(ranked_products)}
         
-        If there are fewer than 3 products, return all available products.
-        Make sure to preserve the original URLs from the input data.
-        """
+        # Compact table of the best candidates; the model answers with IDs only
+        prompt, candidates = build_analysis_prompt(
+            state["user_query"], ranked_products[:self.rerank_top_k], self.prompt_title_tokens, self.max_prompt_tokens
+        )
         
         try:
-            response = await asyncio.to_thread(self.llm.generate_content, prompt)
-            response_text = response.text
-            
-            # Extract JSON from response
-            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-            if json_match:
-                recommendations = json.loads(json_match.group())
-                state["final_recommendations"] = recommendations
+            if _stream_events.get() is not None:
+                response_text = await self.stream_llm_response(prompt, candidates, self.max_output_tokens)
             else:
-                # Fallback: sort by rating and price
-                sorted_products = sorted(
-                    products_for_analysis,
-                    key=lambda x: (-(x["rating"] if isinstance(x["rating"], (int, float)) else 0), x["price"])
+                response_text = await self.llm_client.generate(
+                    prompt, stage="analyze_products", max_output_tokens=self.max_output_tokens
                 )
-                
-                # Format as recommendations
-                recommendations = []
-                for i, product in enumerate(sorted_products[:3], 1):
-                    recommendations.append({
-                        "rank": i,
-                        "name": product["name"],
-                        "price": product["price"],
-                        "rating": product["rating"],
-                        "url": product["url"],
-                        "source": product["source"],
-                        "why_recommended": f"Ranked #{i} based on price and rating"
-                    })
-                
-                state["final_recommendations"] = recommendations
+            
+            recommendations = parse_analysis_response(response_text, candidates)
+            if not recommendations:
+                # Fallback: local ranking
+                recommendations = local_recommendations(ranked_products)
                 
         except Exception as e:
             print(f"Error analyzing products: {e}")
-            # Fallback to top 3 by price
-            sorted_products = sorted(state["scraped_products"], key=lambda x: x["price"])
-            recommendations = []
-            for i, product in enumerate(sorted_products[:3], 1):
-                recommendations.append({
-                    "rank": i,
-                    "name": product["title"],
-                    "price": product["price"],
-                    "rating": product["rating"],
-                    "url": product["url"],
-                    "source": product["source"],
-                    "why_recommended": f"Ranked #{i} by price"
-                })
-            state["final_recommendations"] = recommendations
+            recommendations = local_recommendations(ranked_products)
         
-        return state
+        return {"final_recommendations": recommendations}
+    
+    async def stream_llm_response(self, prompt: str, candidates: Dict[str, Product],
+                                  max_output_tokens: Optional[int] = None) -> str:
+        """Generate with streaming, emitting each pick as a recommendation_token event once it is complete
+        
+        The raw answer is JSON keyed by candidate IDs, so it is not passed on;
+        each finished pick is rehydrated and sent as a "rank. name — why" line.
+        """
+        decoder = json.JSONDecoder()
+        response_text = ""
+        scanned = 0
+        picks = []
+        emitted = 0
+        async for text in self.llm_client.stream(prompt, stage="analyze_products", max_output_tokens=max_output_tokens):
+            response_text += text
+            while (start := response_text.find("{", scanned)) != -1:
+                try:
+                    pick, scanned = decoder.raw_decode(response_text, start)
+                except json.JSONDecodeError:
+                    # Not finished yet
+                    break
+                picks.append(pick)
+            
+            recommendations = parse_analysis_response(json.dumps(picks), candidates)
+            for suggestion in recommendations[emitted:]:
+                line = f"{suggestion['rank']}. {suggestion['name']} — {suggestion['why_recommended']}\n"
+                emit_event("recommendation_token", text=line)
+            emitted = len(recommendations)
+        return response_text
     
     def format_recommendations(self, recommendations: List[Dict[str, Any]]) -> str:
         """Format recommendations for display"""
@@ -714,6 +3267,10 @@ class ShoppingAgent:
             output += f"   ⭐ Rating: {product['rating']}\n"
             output += f"   🛒 Source: {product['source']}\n"
             
+            if len(product.get('offers', [])) > 1:
+                listings = ", ".join(f"{offer['source']} ₹{offer['price']:,.0f}" for offer in product['offers'])
+                output += f"   🏷️ Listed at: {listings}\n"
+            
             if 'why_recommended' in product:
                 output += f"   💡 Why recommended: {product['why_recommended']}\n"
             
@@ -726,34 +3283,344 @@ class ShoppingAgent:
         
         return output
     
-    async def process_query(self, user_query: str) -> str:
-        """Process user query and return recommendations"""
-        initial_state = AgentState(
+    def initial_state(self, user_query: str) -> AgentState:
+        """Build the graph input for a query"""
+        return AgentState(
             messages=[],
             user_query=user_query,
             product_name="",
             budget=0.0,
+            scrape_deadline=0.0,
             scraped_products=[],
-            final_recommendations=[]
+            products=[],
+            final_recommendations=[],
+            timings={}
         )
+    
+    async def run_query(self, user_query: str) -> Dict[str, Any]:
+        """Process a query and return structured results instead of display text
+        
+        The result has the parsed product_name and budget, the
+        recommendations list, per-stage timings in seconds and an error
+        message (None on success). Identical queries that arrive while one is
+        already running wait for its result instead of running again.
+        """
+        query_key = " ".join(user_query.lower().split())
+        result, shared = await self._query_flight.do(query_key, lambda: self._run_query(user_query))
+        if shared:
+            print("🔗 Joined an identical query already in progress")
+        
+        # Each caller gets its own copy of the shared result
+        return {**result, "query": user_query, "timings": dict(result["timings"])}
+    
+    async def _run_query(self, user_query: str) -> Dict[str, Any]:
+        """Run the graph for one query, dumping its span log if profiling is on"""
+        if self.profile_dir:
+            _query_profile.set({"started": time.perf_counter(), "spans": []})
+        searches_ahead = []
+        _searches_ahead.set(searches_ahead)
+        
+        started = time.perf_counter()
+        result = {
+            "query": user_query,
+            "product_name": None,
+            "budget": None,
+            "recommendations": [],
+            "timings": {},
+            "error": None,
+        }
         
         try:
             # Run the graph
-            result = await self.graph.ainvoke(initial_state)
-            
-            # Format and return recommendations
-            return self.format_recommendations(result["final_recommendations"])
-            
+            final_state = await self.graph.ainvoke(self.initial_state(user_query))
+            result.update(
+                product_name=final_state["product_name"],
+                budget=final_state["budget"],
+                recommendations=final_state["final_recommendations"],
+                timings=final_state["timings"],
+            )
         except Exception as e:
-            return f"❌ Error processing your request: {str(e)}"
+            result["error"] = str(e)
+        finally:
+            await self.settle_searches_ahead(searches_ahead)
+        
+        result["timings"]["total"] = round(time.perf_counter() - started, 3)
+        
+        profile = _query_profile.get()
+        if profile is not None:
+            await asyncio.to_thread(self.write_profile, result, profile["spans"])
+        return result
+    
+    def write_profile(self, result: Dict[str, Any], spans: List[Dict[str, Any]]):
+        """Write one query's timings and spans (in start order) as JSON under profile_dir"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        slug = "-".join(re.findall(r"[a-z0-9]+", result["query"].lower()))[:40] or "query"
+        path = os.path.join(self.profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "query": result["query"],
+                "timings": result["timings"],
+                "spans": sorted(spans, key=lambda span: span["start"]),
+            }, f, indent=2, ensure_ascii=False)
+        print(f"🧪 Profile written to {path}")
+    
+    async def process_query(self, user_query: str) -> str:
+        """Process user query and return recommendations"""
+        result = await self.run_query(user_query)
+        if result["error"]:
+            return f"❌ Error processing your request: {result['error']}"
+        
+        # Format and return recommendations
+        return self.format_recommendations(result["recommendations"])
+    
+    async def stream_query(self, user_query: str) -> AsyncIterator[StreamEvent]:
+        """Process a query, yielding results as soon as they are available
+        
+        Event types, in the order they typically arrive:
+          parsed_query          {"product_name", "budget"}
+          product               {"product"}, once per in-budget product as it is extracted
+          site_done             {"site", "count"}, when a retailer branch finishes
+          recommendation_token  {"text"}, one "rank. name — why" line per pick as the model streams it
+          recommendations       {"recommendations"}, the final ranked list
+          error                 {"message"}
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        site_nodes = {f"scrape_{site.lower()}": site for site in self.sites}
+        
+        async def run_graph():
+            searches_ahead = []
+            _searches_ahead.set(searches_ahead)
+            try:
+                async for update in self.graph.astream(self.initial_state(user_query), stream_mode="updates"):
+                    for node, values in update.items():
+                        if node in site_nodes:
+                            emit_event("site_done", site=site_nodes[node], count=len(values["scraped_products"]))
+                        elif node == "analyze_products":
+                            emit_event("recommendations", recommendations=values["final_recommendations"])
+            except Exception as e:
+                emit_event("error", message=str(e))
+            finally:
+                await self.settle_searches_ahead(searches_ahead)
+                queue.put_nowait(None)
+        
+        # The graph task inherits the queue through its context; ours stays clean
+        token = _stream_events.set(queue)
+        try:
+            task = asyncio.create_task(run_graph())
+        finally:
+            _stream_events.reset(token)
+        
+        budget = None
+        try:
+            while (event := await queue.get()) is not None:
+                if event["type"] == "parsed_query":
+                    budget = event["data"]["budget"]
+                # Live scrapes are unfiltered (for the cache), so filter here
+                if event["type"] == "product" and not within_budget(event["data"]["product"], budget):
+                    continue
+                yield event
+        finally:
+            if not task.done():
+                task.cancel()
+    
+    async def close(self):
+        """Shut down the shared browser pool and the result cache"""
+        await self.scraper.close()
+        if self.cache:
+            self.cache.close()
+
+# aiohttp is imported where the server needs it; this only serves the annotations
+class ShoppingServer:
+    """JSON-over-HTTP front end for one long-lived ShoppingAgent
+    
+    At most ``max_in_flight`` queries run at once and up to ``max_queue`` more
+    wait for a slot; anything beyond that is turned away with a 429 so callers
+    back off instead of piling up behind a slow scrape.
+    
+    Endpoints:
+      POST /query   {"query": "..."} -> the run_query result (recommendations, timings, error)
+      GET  /health  browser state and current load (always 200)
+      GET  /metrics latency histograms and counters (Prometheus text, or ?format=json)
+    """
+    
+    def __init__(self, agent: "ShoppingAgent", max_in_flight: int = 8, max_queue: int = 32):
+        self.agent = agent
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.pending = 0  # admitted queries, running or queued
+        self.running = 0
+    
+    def create_app(self) -> "web.Application":
+        """Build the aiohttp application"""
+        from aiohttp import web
+        
+        app = web.Application()
+        app.router.add_post("/query", self.handle_query)
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.on_startup.append(self.warm_up)
+        return app
+    
+    async def warm_up(self, app: "web.Application"):
+        """Get the agent ready before the first request arrives"""
+        await self.agent.warm_up()
+    
+    async def handle_query(self, request: "web.Request") -> "web.Response":
+        """Run one query, or reject it when the server is at capacity"""
+        from aiohttp import web
+        
+        try:
+            body = await request.json()
+        except (ValueError, UnicodeDecodeError):
+            # JSONDecodeError is a ValueError; a non-UTF-8 body fails before parsing
+            return web.json_response({"error": "Request body must be JSON"}, status=400)
+        query = body.get("query") if isinstance(body, dict) else None
+        if not isinstance(query, str) or not query.strip():
+            return web.json_response({"error": 'Missing "query" field'}, status=400)
+        
+        if self.pending >= self.max_in_flight + self.max_queue:
+            return web.json_response(
+                {"error": "Server busy, retry later"}, status=429, headers={"Retry-After": "1"}
+            )
+        
+        self.pending += 1
+        try:
+            async with self._slots:
+                self.running += 1
+                try:
+                    result = await self.agent.run_query(query.strip())
+                finally:
+                    self.running -= 1
+        finally:
+            self.pending -= 1
+        
+        return web.json_response(result, status=500 if result["error"] else 200)
+    
+    async def handle_health(self, request: "web.Request") -> "web.Response":
+        """Report browser state and how busy the server is
+        
+        Always 200: queries still run over plain HTTP without the browser, and
+        a probe must not launch Chromium.
+        """
+        from aiohttp import web
+        
+        return web.json_response({
+            "status": "ok",
+            "browser": self.agent.scraper.browser_connected(),
+            "running": self.running,
+            "queued": self.pending - self.running,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+        })
+    
+    async def handle_metrics(self, request: "web.Request") -> "web.Response":
+        """Export the process metrics"""
+        from aiohttp import web
+        
+        if request.query.get("format") == "json":
+            return web.json_response(METRICS.to_json())
+        return web.Response(text=METRICS.to_prometheus(), content_type="text/plain", charset="utf-8")
+    
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080):
+        """Serve until cancelled"""
+        from aiohttp import web
+        
+        runner = web.AppRunner(self.create_app())
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+            print(f"🌐 Serving on http://{host}:{port} (POST /query, GET /health, GET /metrics)")
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+def read_batch_queries(input_path: str) -> List[Dict[str, Any]]:
+    """Read queries from a JSONL file
+    
+    Each line is either {"query": "...", "id": ...} (id optional) or a bare
+    JSON string. Lines that cannot be read become entries with an error.
+    """
+    queries = []
+    with open(input_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                queries.append({"id": line_number, "query": None, "error": f"Invalid JSON: {e}"})
+                continue
+            
+            if isinstance(record, str):
+                record = {"query": record}
+            if not isinstance(record, dict) or not isinstance(record.get("query"), str):
+                queries.append({"id": line_number, "query": None, "error": 'Missing "query" field'})
+                continue
+            queries.append({"id": record.get("id", line_number), "query": record["query"], "error": None})
+    return queries
+
+async def run_batch(agent: "ShoppingAgent", input_path: str, output_path: str, concurrency: int = 4):
+    """Run every query in a JSONL file through one agent, writing results as they finish"""
+    queries = read_batch_queries(input_path)
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    
+    async def run_one(entry: Dict[str, Any]) -> Dict[str, Any]:
+        if entry["error"]:
+            return {"id": entry["id"], "query": entry["query"], "recommendations": [], "timings": {}, "error": entry["error"]}
+        async with semaphore:
+            return {"id": entry["id"], **await agent.run_query(entry["query"])}
+    
+    failed = 0
+    with open(output_path, "w", encoding="utf-8") as out:
+        for finished, next_result in enumerate(asyncio.as_completed([run_one(entry) for entry in queries]), 1):
+            result = await next_result
+            failed += bool(result["error"])
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            print(f"[{finished}/{len(queries)}] {result['query']!r} -> "
+                  f"{'❌ ' + result['error'] if result['error'] else str(len(result['recommendations'])) + ' recommendations'}")
+    
+    elapsed = time.perf_counter() - started
+    print(f"✅ Processed {len(queries)} queries ({failed} failed) in {elapsed:.1f}s -> {output_path}")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Command line options; without --batch or --serve the interactive chat starts"""
+    parser = argparse.ArgumentParser(description="AI Shopping Assistant")
+    parser.add_argument("--batch", metavar="QUERIES_JSONL", help="process queries from a JSONL file instead of chatting")
+    parser.add_argument("--output", default="results.jsonl", help="where --batch writes its JSONL results")
+    parser.add_argument("--concurrency", type=int, default=4, help="queries processed at once in --batch mode")
+    parser.add_argument("--serve", action="store_true", help="run the JSON HTTP service instead of chatting")
+    parser.add_argument("--host", default="127.0.0.1", help="address --serve listens on")
+    parser.add_argument("--port", type=int, default=8080, help="port --serve listens on")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="queries --serve runs at once")
+    parser.add_argument("--max-queue", type=int, default=32, help="queries --serve queues before answering 429")
+    parser.add_argument("--profile-dir", help="write a per-query span profile (JSON) to this directory")
+    parser.add_argument("--metrics", metavar="METRICS_JSON", help="write the collected latency metrics here on exit")
+    parser.add_argument("--snapshots", metavar="DIR", help="store every fetched results page in this snapshot store")
+    parser.add_argument("--reextract", metavar="OUTPUT_JSONL",
+                        help="re-run extraction over the --snapshots store, write the products here and exit")
+    args = parser.parse_args(argv)
+    if args.reextract and not args.snapshots:
+        parser.error("--reextract needs --snapshots")
+    return args
 
 async def main():
-    """Main function to run the terminal chatbot"""
-    print("🤖 AI Shopping Assistant")
-    print("=" * 50)
-    print("Enter your product query (e.g., 'I want to buy a smartphone under 30k with good camera')")
-    print("Type 'quit' to exit")
-    print("=" * 50)
+    """Main function to run the terminal chatbot (or a batch run with --batch, or the HTTP service with --serve)"""
+    args = parse_args()
+    
+    if args.reextract:
+        await run_reextract(args.snapshots, args.reextract)
+        return
+    
+    if not args.batch and not args.serve:
+        print("🤖 AI Shopping Assistant")
+        print("=" * 50)
+        print("Enter your product query (e.g., 'I want to buy a smartphone under 30k with good camera')")
+        print("Type 'quit' to exit")
+        print("=" * 50)
     
     # Check if API key is set
     if not os.getenv("GOOGLE_API_KEY"):
@@ -761,11 +3628,84 @@ async def main():
         print("Please set your Google API key in the .env file")
         return
     
-    agent = ShoppingAgent()
+    snapshots = SnapshotStore(args.snapshots) if args.snapshots else None
+    agent = ShoppingAgent(profile_dir=args.profile_dir, scraper=ProductScraper(snapshots=snapshots))
+    
+    # The service warms up before it starts listening; otherwise the browser
+    # and model client come up while the user types or the first queries start
+    warm_up = None if args.serve else asyncio.create_task(agent.warm_up())
+    
+    try:
+        if args.batch:
+            await run_batch(agent, args.batch, args.output, args.concurrency)
+        elif args.serve:
+            await ShoppingServer(agent, args.max_in_flight, args.max_queue).serve(args.host, args.port)
+        else:
+            await run_chat_loop(agent)
+    finally:
+        if warm_up and not warm_up.done():
+            warm_up.cancel()
+            await asyncio.gather(warm_up, return_exceptions=True)
+        await agent.close()
+        if snapshots:
+            snapshots.close()
+        if args.metrics:
+            with open(args.metrics, "w", encoding="utf-8") as f:
+                json.dump(METRICS.to_json(), f, indent=2)
+
+async def run_reextract(snapshot_dir: str, output_path: str):
+    """Re-run extraction over stored snapshots with the current selectors and write the products as JSONL"""
+    store = SnapshotStore(snapshot_dir)
+    try:
+        started = time.perf_counter()
+        results = await asyncio.to_thread(store.reextract)
+    finally:
+        store.close()
+    
+    with open(output_path, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    
+    product_count = sum(len(result["products"]) for result in results)
+    print(f"✅ Re-extracted {product_count} products from {len(results)} pages in "
+          f"{time.perf_counter() - started:.1f}s, wrote {output_path}")
+
+async def read_line(prompt: str) -> str:
+    """input() without blocking the event loop, so background work continues while the user types
+    
+    A terminal is read on the event loop's own thread once it has a line, so
+    no thread is ever left blocked in input() at exit. Piped input, and loops
+    that cannot watch stdin (Windows), fall back to a plain input() call.
+    """
+    loop = asyncio.get_running_loop()
+    if not sys.stdin.isatty():
+        return input(prompt)
     
+    line = loop.create_future()
+    
+    def ready():
+        if not line.done():
+            line.set_result(sys.stdin.readline())
+    
+    try:
+        loop.add_reader(sys.stdin.fileno(), ready)
+    except NotImplementedError:
+        return input(prompt)
+    
+    print(prompt, end="", flush=True)
+    try:
+        text = await line
+    finally:
+        loop.remove_reader(sys.stdin.fileno())
+    if not text:
+        raise EOFError
+    return text.rstrip("\n")
+
+async def run_chat_loop(agent: "ShoppingAgent"):
+    """Read queries from the terminal until the user quits"""
     while True:
         try:
-            query = input("\n💬 Your query: ").strip()
+            query = (await read_line("\n💬 Your query: ")).strip()
             
             if query.lower() in ['quit', 'exit', 'q']:
                 print("👋 Thanks for using AI Shopping Assistant!")
@@ -780,11 +3720,15 @@ async def main():
             result = await agent.process_query(query)
             print(result)
             
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, EOFError):
             print("\n👋 Thanks for using AI Shopping Assistant!")
             break
         except Exception as e:
             print(f"❌ Error: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # asyncio.run turns Ctrl+C into a cancellation of main(), which has cleaned up by now
+        print("\n👋 Thanks for using AI Shopping Assistant!")
\ No newline at end of file
@@ -0,0 +1,432 @@
+"""Offline benchmark for the shopping agent
+
+Serves the synthetic search result pages in fixtures/ from a local HTTP server,
+replaces Gemini with a deterministic stub of fixed latency and runs a query
+workload through ShoppingAgent.run_query. Nothing touches the real retailers
+or the Gemini API, so runs are comparable across commits:
+
+    python benchmark.py --rounds 5 --concurrency 4 --output report.json
+    python benchmark.py --baseline report.json --tolerance 0.25   # exits 1 on a regression
+    python benchmark.py --check   # only verify what extraction reads from the fixtures
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from agent import (
+    METRICS, SITE_SELECTORS, LLMClient, ProductScraper, SelectorStats, ShoppingAgent, build_product, extract_search_records,
+    parse_search_html
+)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Search path on each retailer -> fixture file prefix
+FIXTURE_ROUTES = {
+    "/search": "flipkart_search",
+    "/s": "amazon_search",
+}
+
+# A mix of queries the local parser handles and ones that need the (stub) LLM
+DEFAULT_QUERIES = [
+    "smartphone under 20k",
+    "5g phone below 15000",
+    "phone with good camera under 30k",
+    "android phone between 10k and 25k",
+    "I want a phone for my mom that has a big battery",
+    "gaming phone with 12 GB RAM, budget around 40 thousand",
+    "compact phone",
+    "best phone for students",
+]
+
+# Latency and per-card figures compared against a baseline report
+REGRESSION_KEYS = [
+    ("latency", "p50"),
+    ("latency", "p95"),
+    ("parse", "per_card_us"),
+]
+
+class StubResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class StubLLM:
+    """Deterministic LLMClient backend standing in for Gemini, with a fixed latency per call"""
+
+    def __init__(self, latency: float = 0.3):
+        self.latency = latency
+        self.calls = 0
+
+    def respond(self, prompt: str) -> str:
+        self.calls += 1
+        if "Extract the product name" in prompt:
+            query = prompt.rsplit("User query:", 1)[-1].strip()
+            return json.dumps({"product_name": query, "budget": 30000})
+
+        # Recommend the first three products, in the order they were given
+        product_ids = re.findall(r"^(P\d+)\|", prompt, re.MULTILINE)[:3]
+        return json.dumps([{"id": product_id, "why": "stub"} for product_id in product_ids])
+
+    async def generate_content_async(self, prompt: str, generation_config: Optional[Dict[str, Any]] = None, stream: bool = False):
+        await asyncio.sleep(self.latency)
+        response = StubResponse(self.respond(prompt))
+        if not stream:
+            return response
+
+        async def chunks():
+            yield response
+        return chunks()
+
+class FixtureServer:
+    """Serve fixture pages like the retailers' search endpoints, on a background thread
+
+    ``/search?page=N`` returns flipkart_search_N.html and ``/s?page=N``
+    returns amazon_search_N.html, optionally after a fixed delay.
+    """
+
+    def __init__(self, fixture_dir: str = FIXTURE_DIR, latency: float = 0.0):
+        self.pages: Dict[str, bytes] = {}
+        for name in os.listdir(fixture_dir):
+            if name.endswith(".html"):
+                with open(os.path.join(fixture_dir, name), "rb") as f:
+                    self.pages[name[:-len(".html")]] = f.read()
+        self.latency = latency
+        self.requests = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def page_for(self, path: str) -> Optional[bytes]:
+        url = urlparse(path)
+        prefix = FIXTURE_ROUTES.get(url.path)
+        if prefix is None:
+            return None
+        page_number = parse_qs(url.query).get("page", ["1"])[0]
+        return self.pages.get(f"{prefix}_{page_number}")
+
+    def start(self):
+        fixtures = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fixtures.requests += 1
+                if fixtures.latency:
+                    time.sleep(fixtures.latency)
+                body = fixtures.page_for(self.path)
+                self.send_response(200 if body is not None else 404)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body or b"")))
+                self.end_headers()
+                self.wfile.write(body or b"")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """Summary statistics in seconds (empty input gives zeros)"""
+    if not values:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p90": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    array = np.asarray(values)
+    p50, p90, p95, p99 = np.percentile(array, [50, 90, 95, 99])
+    return {
+        "count": len(values),
+        "mean": round(float(array.mean()), 4),
+        "p50": round(float(p50), 4),
+        "p90": round(float(p90), 4),
+        "p95": round(float(p95), 4),
+        "p99": round(float(p99), 4),
+        "max": round(float(array.max()), 4),
+    }
+
+# What parse_search_html must read from one fixture per site: the number of
+# products and every field of the first card
+EXPECTED_EXTRACTION = {
+    "flipkart_search_1.html": {
+        "site": "Flipkart",
+        "count": 20,
+        "first": {
+            "title": "OnePlus Nord CE4 Lite 5G (Blue, 256 GB) (12 GB RAM)",
+            "rating": 3.8,
+            "price": 6499.0,
+            "reviews_count": 66287,
+            "brand": None,
+            "mrp": 7199.0,
+            "discount": 10,
+            "url": "https://www.flipkart.com/oneplus-phone/p/itm0001631262?pid=MOB0001631262&lid=LST0001631262&marketplace=FLIPKART",
+            "source": "Flipkart",
+        },
+    },
+    "amazon_search_1.html": {
+        "site": "Amazon",
+        "count": 20,
+        "first": {
+            "title": "POCO X6 Neo 5G (Blue, 256 GB) (8 GB RAM)",
+            "rating": 4.5,
+            "price": 84599.0,
+            "reviews_count": 74227,
+            "brand": None,
+            "mrp": 120299.0,
+            "discount": 30,
+            "url": "https://www.amazon.in/POCO-Phone/dp/B000008206/ref=sr_1_1",
+            "source": "Amazon",
+        },
+    },
+}
+
+def check_extraction(fixture_dir: str = FIXTURE_DIR) -> List[str]:
+    """Compare parse_search_html on the bundled fixtures with EXPECTED_EXTRACTION; returns the mismatches"""
+    mismatches = []
+    for name, expected in EXPECTED_EXTRACTION.items():
+        with open(os.path.join(fixture_dir, name), encoding="utf-8") as f:
+            products = parse_search_html(f.read(), expected["site"])
+
+        if len(products) != expected["count"]:
+            mismatches.append(f"{name}: {len(products)} products, expected {expected['count']}")
+        if products:
+            for field, value in expected["first"].items():
+                if products[0].get(field) != value:
+                    mismatches.append(f"{name}: first card {field} = {products[0].get(field)!r}, expected {value!r}")
+        for index, product in enumerate(products):
+            if product["brand"] is not None and product["brand"] == product["title"]:
+                mismatches.append(f"{name}: card {index} brand is its title")
+    return mismatches
+
+def benchmark_parse(fixture_dir: str = FIXTURE_DIR, rounds: int = 20) -> Dict[str, Any]:
+    """Time in-process HTML extraction (lxml parse plus product building) over every fixture"""
+    fixtures = []
+    for name in sorted(os.listdir(fixture_dir)):
+        for prefix, site in (("flipkart_search", "Flipkart"), ("amazon_search", "Amazon")):
+            if name.startswith(prefix) and name.endswith(".html"):
+                with open(os.path.join(fixture_dir, name), encoding="utf-8") as f:
+                    fixtures.append((site, f.read()))
+
+    cards = 0
+    products = 0
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for site, html in fixtures:
+            config = SITE_SELECTORS[site]
+            _, records = extract_search_records(html, config["cards"], config["fields"])
+            cards += len(records)
+            products += sum(1 for record in records if build_product(site, record))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "pages": len(fixtures) * rounds,
+        "cards": cards,
+        "products": products,
+        "per_page_ms": round(elapsed / max(len(fixtures) * rounds, 1) * 1000, 3),
+        "per_card_us": round(elapsed / max(cards, 1) * 1e6, 1),
+    }
+
+async def benchmark_queries(shopping_agent: ShoppingAgent, queries: List[str], rounds: int, concurrency: int) -> Dict[str, Any]:
+    """Run every query ``rounds`` times, at most ``concurrency`` at once"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def run_one(query: str):
+        async with semaphore:
+            started = time.perf_counter()
+            result = await shopping_agent.run_query(query)
+            latencies.append(time.perf_counter() - started)
+            if result["error"]:
+                errors.append(result["error"])
+            elif not result["recommendations"]:
+                errors.append(f"No recommendations for {query!r}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*[run_one(query) for _ in range(rounds) for query in queries])
+    elapsed = time.perf_counter() - started
+
+    return {
+        "latency": percentiles(latencies),
+        "throughput_qps": round(len(latencies) / elapsed, 2),
+        "errors": len(errors),
+        "first_errors": errors[:5],
+    }
+
+def extraction_summary() -> Dict[str, Any]:
+    """Per-card extraction time from the metrics recorded during the query workload"""
+    snapshot = METRICS.to_json()
+    cards = sum(
+        counter["value"] for counter in snapshot["counters"]
+        if counter["name"] in ("cards_extracted_total", "cards_dropped_total")
+    )
+    seconds = sum(
+        histogram["sum"] for histogram in snapshot["histograms"]
+        if histogram["name"] == "extract_cards_seconds"
+    )
+    stages = {}
+    for histogram in snapshot["histograms"]:
+        if histogram["count"]:
+            label = ",".join(str(value) for value in histogram["labels"].values())
+            stages[f"{histogram['name']}[{label}]"] = round(histogram["sum"] / histogram["count"] * 1000, 2)
+    return {
+        "cards": int(cards),
+        "per_card_us": round(seconds / cards * 1e6, 1) if cards else None,
+        "mean_ms_by_stage": stages,
+    }
+
+def peak_memory_mb() -> Dict[str, float]:
+    """Peak resident set size of this process and of finished children (the parse workers)"""
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 / 1024 / 1024 if sys.platform == "darwin" else 1 / 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale, 1),
+    }
+
+def find_regressions(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Figures that got slower than the baseline by more than ``tolerance`` (a fraction)"""
+    regressions = []
+    for section, key in REGRESSION_KEYS:
+        current = report.get(section, {}).get(key)
+        previous = baseline.get(section, {}).get(key)
+        if current is None or not previous:
+            continue
+        if current > previous * (1 + tolerance):
+            regressions.append(f"{section}.{key}: {previous} -> {current} (+{(current / previous - 1) * 100:.0f}%)")
+    return regressions
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Start the fixture server, run the workload and build the report"""
+    server = FixtureServer(args.fixtures, args.server_latency)
+    server.start()
+
+    scraper = ProductScraper(
+        extraction_mode=args.extraction_mode,
+        http_first=not args.browser,
+        selector_stats=SelectorStats(path=None),
+        base_urls={site: server.base_url for site in SITE_SELECTORS},
+    )
+    shopping_agent = ShoppingAgent(
+        use_cache=False, scraper=scraper, llm_client=LLMClient(backend=StubLLM(args.llm_latency))
+    )
+
+    queries = args.queries or DEFAULT_QUERIES
+    try:
+        # Browser launch, parse worker start-up and connection set-up are not measured
+        await shopping_agent.warm_up()
+        if args.warmup:
+            await benchmark_queries(shopping_agent, queries, args.warmup, args.concurrency)
+        METRICS.reset()
+        shopping_agent.llm.calls = 0
+        server.requests = 0
+
+        workload = await benchmark_queries(shopping_agent, queries, args.rounds, args.concurrency)
+    finally:
+        await shopping_agent.close()
+        server.stop()
+
+    return {
+        "config": {
+            "rounds": args.rounds,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "llm_latency": args.llm_latency,
+            "server_latency": args.server_latency,
+            "mode": "browser" if args.browser else "http",
+            "extraction_mode": args.extraction_mode,
+        },
+        **workload,
+        "extraction": extraction_summary(),
+        "parse": benchmark_parse(args.fixtures, args.parse_rounds),
+        "llm_calls": shopping_agent.llm.calls,
+        "fixture_requests": server.requests,
+        "peak_memory_mb": peak_memory_mb(),
+    }
+
+def print_report(report: Dict[str, Any]):
+    latency = report["latency"]
+    print("📊 Benchmark results")
+    print("=" * 50)
+    print(f"Queries: {latency['count']} ({report['errors']} errors), {report['throughput_qps']} queries/s "
+          f"at concurrency {report['config']['concurrency']}")
+    print(f"Latency: p50 {latency['p50']:.3f}s  p90 {latency['p90']:.3f}s  p95 {latency['p95']:.3f}s  "
+          f"p99 {latency['p99']:.3f}s  max {latency['max']:.3f}s")
+    extraction = report["extraction"]
+    if extraction["per_card_us"] is not None:
+        print(f"Extraction during queries: {extraction['per_card_us']:.1f}µs per card over {extraction['cards']} cards")
+    parse = report["parse"]
+    print(f"In-process parse: {parse['per_card_us']:.1f}µs per card, {parse['per_page_ms']:.2f}ms per page")
+    memory = report["peak_memory_mb"]
+    print(f"Peak memory: {memory['self']:.0f} MB (parse workers {memory['children']:.0f} MB)")
+    print(f"LLM calls: {report['llm_calls']}, fixture requests: {report['fixture_requests']}")
+    for error in report["first_errors"]:
+        print(f"❌ {error}")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the shopping agent")
+    parser.add_argument("--rounds", type=int, default=3, help="times each query is run")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured rounds run first")
+    parser.add_argument("--concurrency", type=int, default=4, help="queries running at once")
+    parser.add_argument("--query", dest="queries", action="append", help="query to run (repeatable; default: a built-in mix)")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds each stub LLM call takes")
+    parser.add_argument("--server-latency", type=float, default=0.0, help="seconds the fixture server waits per page")
+    parser.add_argument("--browser", action="store_true", help="load pages in Chromium instead of the HTTP fast path")
+    parser.add_argument("--extraction-mode", default="batch", choices=["batch", "locator", "html"], help="browser extraction mode")
+    parser.add_argument("--parse-rounds", type=int, default=20, help="passes over the fixtures in the parse benchmark")
+    parser.add_argument("--fixtures", default=FIXTURE_DIR, help="directory of search page fixtures")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report to compare against; exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against --baseline (0.25 = 25%%)")
+    parser.add_argument("--check", action="store_true", help="only check extraction against the bundled fixtures")
+    return parser.parse_args(argv)
+
+def main() -> int:
+    args = parse_args()
+
+    # Timings of an extractor that reads the wrong values mean nothing
+    mismatches = check_extraction()
+    if mismatches:
+        print("❌ Extraction does not match the fixtures:")
+        for mismatch in mismatches:
+            print(f"   {mismatch}")
+        return 1
+    print("✅ Extraction matches the fixtures")
+    if args.check:
+        return 0
+
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"💾 Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        if regressions:
+            print("❌ Regressions against the baseline:")
+            for regression in regressions:
+                print(f"   {regression}")
+            return 1
+        print("✅ No regressions against the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())